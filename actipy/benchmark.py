@@ -0,0 +1,307 @@
+"""
+Benchmarks the optical flow backends and feature stages on synthetic
+videos with known motion.
+
+Every case runs in a fresh process so its peak memory is its own. For
+each case the per-stage time, frames per second and peak memory are
+reported, along with how far the recovered flow and HooF are from the
+ground truth, so a speedup that changes the features doesn't go
+unnoticed.
+
+  python -m actipy.benchmark --resolutions 160x120,320x240 --grids 3,15
+
+Backends can be given parameters to compare settings, e.g.
+--backends farneback,farneback_warm,farneback_warm:warm_iterations=1
+"""
+
+import argparse
+import ast
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from multiprocessing import Pool
+
+import numpy as np
+import cv2
+
+import actipy.cv_compat as cv_compat
+from actipy.flow_backends import FlowBackend, get_backend, backend_names
+from actipy.optical_flow import OpticalFlow, Flow
+from actipy.optical_flow_features import OpticalFlowFeatures, hoof_magnitude
+from actipy.video_features import VideoFeatures
+from actipy.window_stats import WindowStats
+
+# Per-frame motion of each synthetic video: (dx, dy, degrees, scale)
+MOTIONS = {
+  'translate': (2.0, 1.0, 0.0, 1.0),
+  'rotate': (0.0, 0.0, 1.0, 1.0),
+  'expand': (0.0, 0.0, 0.0, 1.01),
+}
+
+def motion_matrix(motion, width, height):
+  """
+  3x3 affine transform moving the content of one frame to the next,
+  about the frame's center.
+  """
+
+  dx, dy, degrees, scale = MOTIONS[motion]
+  m = np.eye(3)
+  m[:2] = cv2.getRotationMatrix2D((width/2.0, height/2.0), degrees, scale)
+  m[:2, 2] += (dx, dy)
+  return m
+
+def texture(width, height, seed=0):
+  """
+  Deterministic blurred noise texture, twice the frame size so moving
+  it never exposes its edges.
+  """
+
+  rng = np.random.RandomState(seed)
+  noise = (rng.rand(height*2, width*2)*255).astype(np.uint8)
+  return cv2.GaussianBlur(noise, (0, 0), 2)
+
+def synthetic_video(directory, motion, width, height, length, seed=0):
+  """
+  Writes a video of a texture moving by motion_matrix() every frame.
+  """
+
+  path = os.path.join(directory, "%s_%dx%d.avi" % (motion, width, height))
+  tex = texture(width, height, seed)
+  step = motion_matrix(motion, width, height)
+
+  # frame 0 shows the middle of the texture
+  m = np.eye(3)
+  m[:2, 2] = (-width/2.0, -height/2.0)
+
+  writer = cv2.VideoWriter(path, cv_compat.fourcc(*'MJPG'), 25,
+                           (width, height))
+  for i in xrange(length):
+    frame = cv2.warpAffine(tex, m[:2], (width, height),
+                           flags=cv2.INTER_LINEAR,
+                           borderMode=cv2.BORDER_REFLECT)
+    writer.write(cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR))
+    m = step.dot(m)
+  writer.release()
+
+  return path
+
+def ground_truth_flow(motion, width, height):
+  """
+  The flow between every pair of frames of a synthetic video.
+  """
+
+  step = motion_matrix(motion, width, height)
+  y, x = np.mgrid[0:height, 0:width].astype(np.float64)
+  moved_x = step[0, 0]*x + step[0, 1]*y + step[0, 2]
+  moved_y = step[1, 0]*x + step[1, 1]*y + step[1, 2]
+  return np.dstack((moved_x - x, moved_y - y)).astype(np.float32)
+
+def hoof_error(hists, gt_hists):
+  """
+  Mean over cells of half the L1 distance between histograms normalised
+  to sum to one: 0 is identical, 1 is disjoint.
+  """
+
+  def normed(h):
+    with np.errstate(divide='ignore', invalid='ignore'):
+      return np.nan_to_num(h / h.sum(-1)[..., np.newaxis])
+
+  return 0.5*np.abs(normed(hists) - normed(gt_hists)).sum(-1).mean()
+
+class StageTimer:
+
+  def __init__(self):
+    self.totals = defaultdict(float)
+    self._start = None
+
+  def start(self):
+    self._start = time.time()
+
+  def stop(self, stage):
+    now = time.time()
+    self.totals[stage] += now - self._start
+    self._start = now
+
+def parse_backend(spec):
+  """
+  "name:param=value:..." to the backend's name and parameters.
+  """
+
+  name = spec.split(":")[0]
+  params = {}
+  for param in spec.split(":")[1:]:
+    key, value = param.split("=", 1)
+    params[key] = ast.literal_eval(value)
+  return name, params
+
+def run_case(case):
+  """
+  Benchmarks one backend on one synthetic video. Runs in its own process.
+  """
+
+  try:
+    return _run_case(case)
+  except ImportError as e:
+    # backends that need a module that isn't installed
+    return {'error': str(e)}
+
+def _run_case(case):
+  directory, motion, (width, height), backend_name, grids, length, bins, \
+    window_size = case
+
+  path = synthetic_video(directory, motion, width, height, length)
+  gt = ground_truth_flow(motion, width, height)
+  margin = max(width, height)//8
+  interior = (slice(margin, height-margin), slice(margin, width-margin))
+
+  name, params = parse_backend(backend_name)
+  backend = get_backend(name, **params)
+  if not isinstance(backend, FlowBackend):
+    return {'error': "%s doesn't compute dense flow" % (name,)}
+  timer = StageTimer()
+  endpoint_errors = []
+  hists = dict((g, []) for g in grids)
+  magnitudes = dict((g, []) for g in grids)
+  window_stats = {}
+  engine_diff = 0.0
+  video_features = VideoFeatures(path)
+
+  vid = cv_compat.open_vid(path)
+  frames = OpticalFlow(path)._iter_frames(vid)
+  timer.start()
+  for prev_frame, curr_frame, curr_frame_color in frames:
+    timer.stop('decode')
+
+    vectors = backend.calc(prev_frame, curr_frame)
+    timer.stop('flow')
+
+    endpoint_errors.append(np.sqrt(np.square(
+      vectors[interior] - gt[interior]).sum(-1)).mean())
+    off = OpticalFlowFeatures(Flow(vectors, None, None, None))
+
+    for g in grids:
+      timer.start()
+      hist, bin_edges, magnitude = hoof_magnitude(vectors, bins, g, g, True)
+      timer.stop(('hoof+magnitude', g))
+
+      ref_hist, _ = off.cell_hoof(bins, g, g, True)
+      timer.stop(('cell_hoof', g))
+      ref_magnitude = off.magnitude(g, g)
+      timer.stop(('magnitude', g))
+
+      if g not in window_stats:
+        window_stats[g] = WindowStats(hist.shape, window_size)
+      window_stats[g].push(hist, magnitude)
+      if window_stats[g].count == window_size:
+        window_stats[g].summary(bin_edges)
+      timer.stop(('window_stats', g))
+
+      if len(hists[g]) >= window_size:
+        video_features.summarise_features(hists[g][-window_size:],
+                                          magnitudes[g][-window_size:],
+                                          bin_edges)
+      timer.stop(('summarise_features', g))
+
+      hists[g].append(hist)
+      magnitudes[g].append(magnitude)
+      engine_diff = max(engine_diff, np.nanmax(np.abs(hist - ref_hist)),
+                        np.nanmax(np.abs(magnitude - ref_magnitude)))
+
+    timer.start()
+
+  n = len(endpoint_errors)
+  gt_errors = {}
+  for g in grids:
+    gt_hist, _, _ = hoof_magnitude(gt, bins, g, g, True)
+    gt_errors[g] = hoof_error(np.nanmean(hists[g], 0), gt_hist)
+
+  return {
+    'frames': n,
+    'fps': n / (timer.totals['decode'] + timer.totals['flow']),
+    'ms_per_frame': dict((k, 1000*v/n) for k, v in timer.totals.items()),
+    'peak_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    'endpoint_error': float(np.mean(endpoint_errors)),
+    'hoof_error': gt_errors,
+    'engine_diff': engine_diff,
+  }
+
+def isolated(func, arg):
+  pool = Pool(1, maxtasksperchild=1)
+  try:
+    return pool.apply(func, (arg,))
+  finally:
+    pool.close()
+    pool.join()
+
+# Stages timed once per frame, and once per frame and grid
+FRAME_STAGES = ['decode', 'flow']
+GRID_STAGES = ['hoof+magnitude', 'cell_hoof', 'magnitude', 'window_stats',
+               'summarise_features']
+
+def report(motion, resolution, backend, result, grids, max_hoof_error):
+  name = "%s %dx%d %s" % ((motion,) + resolution + (backend,))
+  if 'error' in result:
+    print "%s: unavailable (%s)" % (name, result['error'])
+    return True
+
+  print "%s: %d frames, %.1f fps, peak %.1f MB, endpoint error %.3f px" % (
+    name, result['frames'], result['fps'], result['peak_mb'],
+    result['endpoint_error'])
+  ms_per_frame = result['ms_per_frame']
+  print "  ms/frame: " + ", ".join("%s %.2f" % (s, ms_per_frame[s])
+                                   for s in FRAME_STAGES)
+  for g in grids:
+    print "  %dx%d ms/frame: " % (g, g) + ", ".join(
+      "%s %.2f" % (s, ms_per_frame[(s, g)]) for s in GRID_STAGES)
+
+  ok = result['engine_diff'] < 1e-4
+  print "  engine vs cell_hoof/magnitude max diff: %.2g" % (
+    result['engine_diff'],)
+  for g in grids:
+    error = result['hoof_error'][g]
+    passed = max_hoof_error is None or error <= max_hoof_error
+    ok = ok and passed
+    print "  %dx%d HooF error vs ground truth: %.3f%s" % (
+      g, g, error, "" if passed else " FAIL")
+
+  return ok
+
+def main(args):
+  parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+  parser.add_argument('--backends', default=",".join(backend_names()))
+  parser.add_argument('--motions', default=",".join(sorted(MOTIONS)))
+  parser.add_argument('--resolutions', default="160x120,320x240")
+  parser.add_argument('--grids', default="3,15")
+  parser.add_argument('--frames', type=int, default=30)
+  parser.add_argument('--bins', type=int, default=8)
+  parser.add_argument('--window-size', type=int, default=16)
+  parser.add_argument('--max-hoof-error', type=float, default=None,
+                      help="exit non-zero if any HooF error exceeds this")
+  opts = parser.parse_args(args)
+
+  resolutions = [tuple(int(d) for d in r.split("x"))
+                 for r in opts.resolutions.split(",")]
+  grids = [int(g) for g in opts.grids.split(",")]
+
+  directory = tempfile.mkdtemp(prefix="actipy_benchmark_")
+  ok = True
+  try:
+    for motion in opts.motions.split(","):
+      for resolution in resolutions:
+        for backend in opts.backends.split(","):
+          case = (directory, motion, resolution, backend, grids,
+                  opts.frames, opts.bins, opts.window_size)
+          result = isolated(run_case, case)
+          ok = report(motion, resolution, backend, result, grids,
+                      opts.max_hoof_error) and ok
+  finally:
+    shutil.rmtree(directory)
+
+  return 0 if ok else 1
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
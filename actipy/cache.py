@@ -0,0 +1,36 @@
+import hashlib
+import json
+import os
+
+# Utils to name on-disk caches of things derived from videos
+
+CACHE_DIR = "models"
+
+_fingerprints = {}
+
+def fingerprint(path, block_size=1<<20):
+  """
+  md5 of a file's content. Memoized on path, size and mtime so a video
+  is only read once per process.
+  """
+
+  st = os.stat(path)
+  memo_key = (os.path.abspath(path), st.st_size, st.st_mtime)
+  if memo_key not in _fingerprints:
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+      for block in iter(lambda: f.read(block_size), b''):
+        md5.update(block)
+    _fingerprints[memo_key] = md5.hexdigest()
+
+  return _fingerprints[memo_key]
+
+def cache_key(*parts):
+  """
+  Stable digest of any JSON-serialisable parameters.
+  """
+
+  return hashlib.md5(json.dumps(parts, sort_keys=True)).hexdigest()
+
+def cache_path(kind, *parts):
+  return os.path.join(CACHE_DIR, "%s_%s.afs" % (kind, cache_key(*parts)))
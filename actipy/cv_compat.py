@@ -1,10 +1,49 @@
-import cv
+import importlib
 import cv2
 import numpy as np
 
-def gray_copy(im):
+class _LazyModule:
+  """
+  Imports a module the first time one of its attributes is used.
+  """
+
+  def __init__(self, name):
+    self._name = name
+    self._module = None
+
+  def __getattr__(self, attr):
+    if self._module is None:
+      self._module = importlib.import_module(self._name)
+    return getattr(self._module, attr)
+
+# The legacy OpenCV 1 API is only needed for its own image and capture
+# types and the algorithms that only it has, so code that sticks to cv2
+# never imports it.
+cv = _LazyModule("cv")
+
+def _cap_prop(name):
+  # OpenCV 3+ has cv2.CAP_PROP_*, 2.4 only cv2.cv.CV_CAP_PROP_*
+  if hasattr(cv2, 'CAP_PROP_' + name):
+    return getattr(cv2, 'CAP_PROP_' + name)
+  return getattr(cv2.cv, 'CV_CAP_PROP_' + name)
+
+CAP_PROP_FRAME_COUNT = _cap_prop('FRAME_COUNT')
+CAP_PROP_FRAME_WIDTH = _cap_prop('FRAME_WIDTH')
+CAP_PROP_FRAME_HEIGHT = _cap_prop('FRAME_HEIGHT')
+CAP_PROP_FPS = _cap_prop('FPS')
+CAP_PROP_POS_FRAMES = _cap_prop('POS_FRAMES')
+
+LINE_AA = getattr(cv2, 'LINE_AA', None) or cv2.CV_AA
+
+def fourcc(*chars):
+  # OpenCV 3+ has cv2.VideoWriter_fourcc, 2.4 only cv2.cv.CV_FOURCC
+  if hasattr(cv2, 'VideoWriter_fourcc'):
+    return cv2.VideoWriter_fourcc(*chars)
+  return cv2.cv.CV_FOURCC(*chars)
+
+def gray_copy(im, out=None):
     if is_cv2(im):
-      return cv2.cvtColor(im,cv2.COLOR_BGR2GRAY)
+      return cv2.cvtColor(im,cv2.COLOR_BGR2GRAY,dst=out)
     else:
       gray = cv.CreateImage(cv.GetSize(im), cv.IPL_DEPTH_8U, 1)
       cv.CvtColor(im, gray, cv.CV_BGR2GRAY)
@@ -49,18 +88,84 @@ def get_dims(im):
 def is_cv2(o):
   return (isinstance(o, np.ndarray) or type(o).__name__ == 'VideoCapture')
 
-def get_frame(vid):
+def get_frame(vid, out=None):
+  """
+  Decodes the next frame, into out if it's given and an array of the
+  right size.
+  """
+
   try:
-    return vid.read()[1]
+    if out is None:
+      return vid.read()[1]
+    ok, frame = vid.read(out)
+    return frame if ok else None
   except AttributeError:
     return cv.QueryFrame(vid)
 
 def get_vid_length(vid):
   if is_cv2(vid):
-    return int(vid.get(cv.CV_CAP_PROP_FRAME_COUNT))
+    return int(vid.get(CAP_PROP_FRAME_COUNT))
   else:
     return int(cv.GetCaptureProperty(vid, cv.CV_CAP_PROP_FRAME_COUNT))
 
+def get_vid_dims(vid):
+  if is_cv2(vid):
+    return (int(vid.get(CAP_PROP_FRAME_WIDTH)),
+            int(vid.get(CAP_PROP_FRAME_HEIGHT)))
+  else:
+    return (int(cv.GetCaptureProperty(vid, cv.CV_CAP_PROP_FRAME_WIDTH)),
+            int(cv.GetCaptureProperty(vid, cv.CV_CAP_PROP_FRAME_HEIGHT)))
+
+def get_vid_fps(vid):
+  if is_cv2(vid):
+    return vid.get(CAP_PROP_FPS)
+  else:
+    return cv.GetCaptureProperty(vid, cv.CV_CAP_PROP_FPS)
+
+def seek_vid(vid, pos):
+  if is_cv2(vid):
+    return vid.set(CAP_PROP_POS_FRAMES, pos)
+  else:
+    return cv.SetCaptureProperty(vid, cv.CV_CAP_PROP_POS_FRAMES, pos)
+
+def get_vid_pos(vid):
+  if is_cv2(vid):
+    return int(vid.get(CAP_PROP_POS_FRAMES))
+  else:
+    return int(cv.GetCaptureProperty(vid, cv.CV_CAP_PROP_POS_FRAMES))
+
+def seek_frame(vid, pos):
+  """
+  Seeks to frame pos. Seeking in some containers (e.g. mp4/h264) only
+  lands near pos, in which case the video is rewound and decoded up to
+  pos instead.
+  """
+
+  seek_vid(vid, pos)
+  if get_vid_pos(vid) == pos:
+    return
+  seek_vid(vid, 0)
+  for _ in xrange(pos):
+    skip_frame(vid)
+
+def skip_frame(vid):
+  """
+  Advances past a frame without decoding it.
+  """
+
+  if is_cv2(vid):
+    return vid.grab()
+  else:
+    return cv.GrabFrame(vid)
+
+def resize(im, dims, out=None):
+  if is_cv2(im):
+    return cv2.resize(im, dims, dst=out, interpolation=cv2.INTER_AREA)
+  else:
+    resized = cv.CreateImage(dims, im.depth, im.nChannels)
+    cv.Resize(im, resized, cv.CV_INTER_AREA)
+    return resized
+
 def open_vid(path):
   return cv2.VideoCapture(path)
 
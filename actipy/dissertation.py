@@ -1,44 +1,236 @@
+import cPickle as pickle
+import time
+import warnings
+
 import numpy as np
 import cv2
 
+import sklearn
 from sklearn import svm
 from sklearn.decomposition import PCA
+from sklearn.linear_model import LogisticRegression
+from sklearn.neighbors import KNeighborsClassifier
 from sklearn.metrics import confusion_matrix, accuracy_score, roc_curve, auc
 import matplotlib.pyplot as plt
 from matplotlib import cm
 
+import actipy.cv_compat as cv_compat
 from actipy.video_features import VideoFeatures
+from actipy.flow_backends import get_backend
+from actipy.incremental import fit_incremental
 from actipy.plan import good_cells, vid_dims
+from actipy.settings import DEFAULT_SETTINGS
+
+BUNDLE_VERSION = 1
+
+# Classifiers fitted to the PCA features, by name: each takes whether
+# probabilities are wanted plus its parameters, which override the
+# defaults. svm is the most accurate but its cost grows with the number
+# of support vectors; linear and knn (a k-d tree over the PCA space,
+# which is only 6 dimensional) are cheaper per prediction.
+CLASSIFIER_DEFAULTS = {
+    'svm': {'class_weight': 'auto'},
+    'linear': {'class_weight': 'auto'},
+    'knn': {'n_neighbors': 5, 'weights': 'uniform', 'algorithm': 'kd_tree'},
+}
+
+
+def make_classifier(name, probabalistic, **params):
+    """
+    Instantiate the classifier called name. Raises ValueError if there's
+    no such classifier.
+    """
+
+    if name not in CLASSIFIER_DEFAULTS:
+        raise ValueError("Unknown classifier %r, choose from %s" % (
+            name, ", ".join(sorted(CLASSIFIER_DEFAULTS))))
+
+    params = dict(CLASSIFIER_DEFAULTS[name], **params)
+    if name == 'svm':
+        return svm.SVC(probability=probabalistic, **params)
+    if name == 'linear':
+        return LogisticRegression(**params)
+    return KNeighborsClassifier(**params)
 
 
 class DissertationPredictor:
 
     def __init__(self, training_feature_path, training_category_path,
-                 probabalistic=False):
-        feature_vectors = np.load(training_feature_path)
+                 probabalistic=False, settings=None, incremental=False,
+                 chunk_size=1000, classifier=None, classifier_params=None):
+        """
+        Fit PCA and the classifier called classifier (see
+        make_classifier()) to the training features. With
+        incremental=True the features are memory-mapped and fitted
+        chunk_size rows at a time with incremental PCA and logistic
+        regression instead, for training sets that don't fit in memory;
+        only the linear classifier can be fitted that way, and
+        classifier_params go to its SGDClassifier. The default classifier
+        is svm, or linear if incremental.
+        """
+
+        if classifier is None:
+            classifier = 'linear' if incremental else 'svm'
+
         categories = np.load(training_category_path)
 
         self.probabalistic = probabalistic
+        self.settings = dict(DEFAULT_SETTINGS, **(settings or {}))
+        self.classifier_name = classifier
+        self.latencies = []
+
+        if incremental:
+            if classifier != 'linear':
+                raise ValueError("Only the linear classifier can be fitted "
+                                 "incrementally, not %r" % (classifier,))
+            feature_vectors = np.load(training_feature_path, mmap_mode='r')
+            self.pca, self.classifier = fit_incremental(
+                feature_vectors, categories, n_components=6,
+                chunk_size=chunk_size, classifier_params=classifier_params)
+            return
+
+        feature_vectors = np.load(training_feature_path)
 
         # Calculate PCA features
         self.pca = PCA(n_components=6)
         pca_feature_vectors = self.pca.fit_transform(feature_vectors)
 
-        # Fit SVM
-        self.classifier = svm.SVC(
-            class_weight='auto', probability=self.probabalistic)
+        self.classifier = make_classifier(classifier, self.probabalistic,
+                                          **(classifier_params or {}))
         self.classifier.fit(pca_feature_vectors, categories)
 
+    def save(self, path):
+        """
+        Save the fitted PCA and classifier together with the feature
+        extraction settings, so load() can skip training.
+        """
+
+        bundle = {
+            'version': BUNDLE_VERSION,
+            'sklearn_version': sklearn.__version__,
+            'probabalistic': self.probabalistic,
+            'settings': self.settings,
+            'classes': list(self.classifier.classes_),
+            'classifier_name': self.classifier_name,
+            'pca': self.pca,
+            'classifier': self.classifier,
+        }
+        with open(path, 'wb') as f:
+            pickle.dump(bundle, f, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a predictor written by save(). Raises ValueError if the file
+        isn't a bundle of this version or its flow backend isn't
+        available.
+        """
+
+        with open(path, 'rb') as f:
+            bundle = pickle.load(f)
+
+        if not isinstance(bundle, dict) or 'version' not in bundle:
+            raise ValueError("%s is not a predictor bundle" % (path,))
+        if bundle['version'] != BUNDLE_VERSION:
+            raise ValueError("%s is a version %s predictor bundle, expected %s"
+                             % (path, bundle['version'], BUNDLE_VERSION))
+        if list(bundle['classifier'].classes_) != bundle['classes']:
+            raise ValueError("%s has inconsistent classes" % (path,))
+
+        settings = bundle['settings']
+        # raises ValueError if the flow backend or its parameters aren't
+        # available in this version of actipy
+        get_backend(settings['flow'], **settings['flow_params'])
+        if bundle['sklearn_version'] != sklearn.__version__:
+            warnings.warn("%s was saved with scikit-learn %s, running %s" % (
+                path, bundle['sklearn_version'], sklearn.__version__))
+
+        predictor = cls.__new__(cls)
+        predictor.probabalistic = bundle['probabalistic']
+        predictor.settings = settings
+        # bundles from before classifiers were selectable are all svm
+        predictor.classifier_name = bundle.get('classifier_name', 'svm')
+        predictor.latencies = []
+        predictor.pca = bundle['pca']
+        predictor.classifier = bundle['classifier']
+        return predictor
+
+    def _cells(self, path):
+        x_guess, y_guess = self.settings['grid']
+        return good_cells(path, x_guess, y_guess, self.settings['scale'])
+
+    def _video_features(self, path, **kwargs):
+        return VideoFeatures(path, bins=self.settings['bins'],
+                             density=self.settings['density'],
+                             scale=self.settings['scale'],
+                             stride=self.settings['stride'],
+                             flow_backend=self.settings['flow'],
+                             flow_params=self.settings['flow_params'],
+                             **kwargs)
+
+    def classify(self, fv):
+        """
+        Classify a single feature vector. Returns class probabilities if
+        the predictor is probabalistic, otherwise the class.
+        """
+
+        return self.classify_batch(fv.reshape(1, -1))[0]
+
+    def classify_batch(self, fvs):
+        """
+        Classify a matrix of feature vectors, one per row, with a single
+        PCA and classifier call. Returns one row of class probabilities
+        or one class per feature vector.
+
+        The time the call takes and the number of feature vectors are
+        added to latencies, for latency_report().
+        """
+
+        start = time.time()
+        pca_fvs = self.pca.transform(fvs)
+        if self.probabalistic:
+            predictions = self.classifier.predict_proba(pca_fvs)
+        else:
+            predictions = self.classifier.predict(pca_fvs)
+
+        self.latencies.append((time.time() - start, len(fvs)))
+        return predictions
+
+    def latency_report(self):
+        """
+        One line summarising the classify_batch() calls so far: the mean
+        time per prediction, and the distribution of the time per call,
+        in milliseconds. Calls are only timed as a whole, so the
+        distribution is of single predictions only when every call
+        classified one feature vector, as classify() does.
+        """
+
+        if not self.latencies:
+            return "%s: no predictions" % (self.classifier_name,)
+
+        seconds, sizes = np.array(self.latencies).T
+        ms = 1000*seconds
+        return ("%s: %.3f ms mean per prediction over %d predictions; "
+                "per call of up to %d: %.3f ms median, %.3f ms 95th "
+                "percentile, %.3f ms max" % (
+                    self.classifier_name, ms.sum() / sizes.sum(),
+                    sizes.sum(), sizes.max(), np.median(ms),
+                    np.percentile(ms, 95), ms.max()))
+
     def predict(self, path):
-        x_cells, y_cells = good_cells(path, 3, 3)
+        """
+        Classify a whole video as one window, like classify().
+        """
 
-        avg_hists, bin_edges, avg_magnitudes, variances, flow = VideoFeatures(
-            path).calc_window_features(x_cells, y_cells, None)
+        x_cells, y_cells = self._cells(path)
+
+        avg_hists, bin_edges, avg_magnitudes, variances, flow = \
+            self._video_features(path, cache_features=True).calc_window_features(
+                x_cells, y_cells, None)
         fv = np.concatenate((avg_hists.flatten(), avg_magnitudes.flatten(),
                             variances.flatten()))
 
-        prediction = self.classifier.predict(self.pca.transform(fv))[0]
-        return prediction
+        return self.classify(fv)
 
     def read_labels(self, path):
         labels = []
@@ -100,45 +292,74 @@ class DissertationPredictor:
 
 
 
+    def _classify_windows(self, windows, labels, window_size, predictions,
+                          true_labels, v):
+        positions, fvs, flows = zip(*windows)
+        for pos, prediction, flow in zip(positions,
+                                         self.classify_batch(np.array(fvs)),
+                                         flows):
+            # flows replayed from the cache carry no frames
+            if flow is not None and flow.curr_frame is not None:
+                vis = flow.show("Prediction", flow=False, text=prediction,
+                                display=True)
+                flow.show("Flow", flow=True, display=True)
+                v.write(vis)
+
+            # prediction is centered on current_time-window_size/2
+            # and current_time=window_size+pos
+            # => prediction is for (window_size/2)+pos, in strided frames
+            predictions.append(prediction)
+            true_labels.append(
+                labels[((window_size/2)+pos)*self.settings['stride']])
+
     def realtime_predict(self, test_path, label_path, window_size, start, end,
-                         output):
+                         output, batch_size=64):
+        """
+        Classifies every window of test_path between frames start and end
+        against the labels in label_path. Windows are classified
+        batch_size at a time; with batch_size=1 the latency report gives
+        the distribution of single prediction latencies.
+        """
+
         labels = self.read_labels(label_path)
-        x_cells, y_cells = good_cells(test_path, 3, 3)
+        x_cells, y_cells = self._cells(test_path)
 
         v = cv2.VideoWriter()
-        dims = vid_dims(test_path)
-        codec = cv2.cv.CV_FOURCC('m', 'p', '4', 'v')
+        dims = vid_dims(test_path, self.settings['scale'])
+        codec = cv_compat.fourcc('m', 'p', '4', 'v')
         v.open(output, codec, 15, dims, 1)
 
         predictions = []
         true_labels = []
-        for pos, agg_features in enumerate(VideoFeatures(
-                test_path, persist=True).aggregate_features(
+        windows = []
+        # only non-probabalistic predictions are drawn
+        for pos, agg_features in enumerate(self._video_features(
+                test_path, persist=True,
+                keep_frames=not self.probabalistic).aggregate_features(
                 x_cells, y_cells, window_size)):
-            if window_size+pos < start:
+            # start and end are frames of the video, pos counts strided
+            # frames
+            frame = (window_size+pos)*self.settings['stride']
+            if frame < start:
                 continue
-            if window_size+pos > end:
+            if frame > end:
                 break
 
             avg_hists, bin_edges, avg_magnitudes, variances, flow = agg_features
             fv = np.concatenate((avg_hists.flatten(), avg_magnitudes.flatten(),
                                 variances.flatten()))
 
-            if self.probabalistic:
-                prediction = self.classifier.predict_proba(
-                        self.pca.transform(fv))[0]
-            else:
-                prediction = self.classifier.predict(self.pca.transform(fv))[0]
-                vis = flow.show("Prediction", flow=False, text=prediction,
-                                display=True)
-                flow.show("Flow", flow=True, display=True)
-                v.write(vis)
+            # only non-probabalistic predictions are drawn, so don't hold
+            # on to flows otherwise
+            windows.append((pos, fv, None if self.probabalistic else flow))
+            if len(windows) == batch_size:
+                self._classify_windows(windows, labels, window_size,
+                                       predictions, true_labels, v)
+                windows = []
 
-            # prediction is centered on current_time-window_size/2
-            # and current_time=window_size+pos
-            # => prediction is for (window_size/2)+pos
-            predictions.append(prediction)
-            true_labels.append(labels[(window_size/2)+pos])
+        if windows:
+            self._classify_windows(windows, labels, window_size, predictions,
+                                   true_labels, v)
 
         print
 
@@ -149,6 +370,7 @@ class DissertationPredictor:
             confmat = confusion_matrix(true_labels, predictions, confmat_labels)
             self.draw_confmat(confmat, confmat_labels)
             print "Accuracy: ", accuracy_score(true_labels, predictions)
+        print "Latency:", self.latency_report()
 
         v.release()
 
@@ -162,7 +384,10 @@ if __name__ == "__main__":
     start = int(argv[6])
     end = int(argv[7])
     output = argv[8]
+    classifier = argv[10] if len(argv) > 10 else None
     dp = DissertationPredictor(training_feature_path, training_category_path,
-                               probabalistic=True)
+                               probabalistic=True, classifier=classifier)
+    if len(argv) > 9:
+        dp.save(argv[9])
     #print dp.predict(test_path)
     dp.realtime_predict(test_path, label_path, window_size, start, end, output)
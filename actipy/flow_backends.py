@@ -0,0 +1,253 @@
+import numpy as np
+import cv2
+
+from actipy.cv_compat import cv
+
+# Registry of optical flow algorithms, looked up by name. The legacy
+# OpenCV 1 module is imported lazily (see cv_compat.cv), so it's only
+# needed once a backend that uses it computes flow. Dense backends are
+# FlowBackends with calc(); sparse_lk is a SparseTracker with track().
+
+# flags used to be OPTFLOW_FARNEBACK_GAUSSIAN & OPTFLOW_USE_INITIAL_FLOW,
+# which is 0, so neither was ever on. Warm starting is the
+# farneback_warm backend.
+FARNEBACK_PARAMS = dict(pyr_scale=0.5, levels=3, winsize=20, iterations=5,
+                        poly_n=7, poly_sigma=1.5, flags=0)
+
+_backends = {}
+
+def register_backend(name, backend):
+  """
+  Register a flow backend class, instantiated with its parameters by
+  get_backend().
+  """
+
+  _backends[name] = backend
+
+def backend_names():
+  return sorted(_backends)
+
+def get_backend(name, **params):
+  """
+  Instantiate the backend registered as name. params override its
+  defaults.
+  """
+
+  if name not in _backends:
+    raise ValueError("Unknown flow backend %r, choose from %s" %
+                     (name, ", ".join(backend_names())))
+  return _backends[name](**params)
+
+def _params(name, defaults, params):
+  unknown = set(params) - set(defaults)
+  if unknown:
+    raise ValueError("Unknown %s parameters: %s" %
+                     (name, ", ".join(sorted(unknown))))
+  return dict(defaults, **params)
+
+class FlowBackend:
+  """
+  Computes dense optical flow between two grayscale frames.
+
+  params holds every setting that affects the result, so it can be used
+  in cache keys. Subclasses implement calc() and may keep preallocated
+  scratch buffers between calls.
+  """
+
+  name = None
+  defaults = {}
+
+  def __init__(self, **params):
+    self.params = _params(self.name, self.defaults, params)
+
+  def reset(self):
+    """
+    Forget any state kept from previous frames, before starting on a
+    new sequence of frames.
+    """
+
+    pass
+
+  @staticmethod
+  def _output(frame, out):
+    if out is None:
+      out = np.empty(frame.shape[:2] + (2,), np.float32)
+    return out
+
+  def calc(self, prev_frame, curr_frame, out=None):
+    """
+    Returns the (H, W, 2) flow from prev_frame to curr_frame, written to
+    out if given.
+    """
+
+    raise NotImplementedError
+
+class Farneback(FlowBackend):
+
+  name = "farneback"
+  defaults = FARNEBACK_PARAMS
+
+  def calc(self, prev_frame, curr_frame, out=None):
+    return cv2.calcOpticalFlowFarneback(prev_frame, curr_frame, flow=out,
+                                        **self.params)
+
+class WarmFarneback(Farneback):
+  """
+  Farneback seeded with the flow of the previous frame pair.
+
+  Adjacent flows are very alike, so once seeded a coarser pyramid of
+  warm_levels levels and warm_iterations iterations per level are
+  enough. The first pair after reset(), and every refresh_interval-th
+  pair if set, is computed from scratch with the full settings.
+  """
+
+  name = "farneback_warm"
+  defaults = dict(FARNEBACK_PARAMS, warm_levels=1, warm_iterations=2,
+                  refresh_interval=None)
+
+  def __init__(self, **params):
+    Farneback.__init__(self, **params)
+    self.reset()
+
+  def reset(self):
+    self._prev_flow = None
+    self._pairs = 0
+
+  def calc(self, prev_frame, curr_frame, out=None):
+    params = dict(self.params)
+    warm_levels = params.pop('warm_levels')
+    warm_iterations = params.pop('warm_iterations')
+    refresh_interval = params.pop('refresh_interval')
+
+    seed = self._prev_flow
+    if seed is not None and (seed.shape[:2] != prev_frame.shape[:2] or
+        refresh_interval and self._pairs % refresh_interval == 0):
+      seed = None
+
+    if seed is not None:
+      if out is None:
+        out = seed.copy()
+      elif out is not seed:
+        np.copyto(out, seed)
+      params.update(levels=warm_levels, iterations=warm_iterations,
+                    flags=params['flags'] | cv2.OPTFLOW_USE_INITIAL_FLOW)
+
+    self._prev_flow = cv2.calcOpticalFlowFarneback(prev_frame, curr_frame,
+                                                   flow=out, **params)
+    self._pairs += 1
+    return self._prev_flow
+
+class _LegacyBackend(FlowBackend):
+  """
+  Base for the OpenCV 1 algorithms, which write x and y flow to separate
+  preallocated matrices.
+  """
+
+  def __init__(self, **params):
+    FlowBackend.__init__(self, **params)
+    self.velx = self.vely = None
+
+  def calc(self, prev_frame, curr_frame, out=None):
+    h, w = prev_frame.shape[:2]
+    if self.velx is None or (self.velx.rows, self.velx.cols) != (h, w):
+      self.velx = cv.CreateMat(h, w, cv.CV_32FC1)
+      self.vely = cv.CreateMat(h, w, cv.CV_32FC1)
+
+    self._calc(cv.fromarray(prev_frame), cv.fromarray(curr_frame))
+
+    out = self._output(prev_frame, out)
+    out[..., 0] = np.asarray(self.velx)
+    out[..., 1] = np.asarray(self.vely)
+    return out
+
+class LucasKanade(_LegacyBackend):
+
+  name = "lucas_kanade"
+  defaults = dict(win_size=(15, 15))
+
+  def _calc(self, prev_frame, curr_frame):
+    cv.CalcOpticalFlowLK(prev_frame, curr_frame,
+                         tuple(self.params['win_size']), self.velx, self.vely)
+
+class HornSchunck(_LegacyBackend):
+
+  name = "horn_schunck"
+  defaults = dict(lambda_=0.001, iterations=100)
+
+  def _calc(self, prev_frame, curr_frame):
+    term_crit = (cv.CV_TERMCRIT_ITER, self.params['iterations'], 0)
+    cv.CalcOpticalFlowHS(prev_frame, curr_frame, False, self.velx, self.vely,
+                         self.params['lambda_'], term_crit)
+
+class SparseTracker:
+  """
+  Sparse optical flow: tracks Shi-Tomasi corners from frame to frame
+  with pyramidal Lucas-Kanade instead of computing flow at every pixel.
+
+  Corners are detected again every detect_interval frame pairs, or as
+  soon as every track is lost. With back_threshold set, points are also
+  tracked backwards and dropped unless they land within back_threshold
+  pixels of where they started.
+
+  Unlike a FlowBackend it keeps state between calls, so a tracker must
+  only be used on one sequence of frames at a time, with reset() in
+  between.
+  """
+
+  name = "sparse_lk"
+  defaults = dict(max_corners=200, quality=0.01, min_distance=8,
+                  detect_interval=10, win_size=(15, 15), max_level=2,
+                  back_threshold=1.0)
+
+  def __init__(self, **params):
+    self.params = _params(self.name, self.defaults, params)
+    self.reset()
+
+  def reset(self):
+    self._points = None
+    self._pairs = 0
+
+  def _detect(self, frame):
+    return cv2.goodFeaturesToTrack(frame, self.params['max_corners'],
+                                   self.params['quality'],
+                                   self.params['min_distance'])
+
+  def _track(self, from_frame, to_frame, points):
+    moved, status, _ = cv2.calcOpticalFlowPyrLK(
+      from_frame, to_frame, points, None,
+      winSize=tuple(self.params['win_size']),
+      maxLevel=self.params['max_level'],
+      criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
+    return moved, status.ravel() == 1
+
+  def track(self, prev_frame, curr_frame):
+    """
+    Returns the (N, 2) x, y positions in prev_frame of the points that
+    were tracked to curr_frame, and their (N, 2) displacements.
+    """
+
+    points = self._points
+    if points is None or not len(points) or \
+        self._pairs % self.params['detect_interval'] == 0:
+      points = self._detect(prev_frame)
+    self._pairs += 1
+
+    if points is None or not len(points):
+      self._points = None
+      return np.empty((0, 2), np.float32), np.empty((0, 2), np.float32)
+
+    moved, good = self._track(prev_frame, curr_frame, points)
+    if self.params['back_threshold'] is not None:
+      back, back_good = self._track(curr_frame, prev_frame, moved)
+      error = np.abs(points - back).reshape(-1, 2).max(-1)
+      good &= back_good & (error < self.params['back_threshold'])
+
+    self._points = moved[good]
+    points = points[good].reshape(-1, 2)
+    return points, moved[good].reshape(-1, 2) - points
+
+register_backend("farneback", Farneback)
+register_backend("farneback_warm", WarmFarneback)
+register_backend("lucas_kanade", LucasKanade)
+register_backend("horn_schunck", HornSchunck)
+register_backend("sparse_lk", SparseTracker)
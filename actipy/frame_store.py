@@ -0,0 +1,98 @@
+import json
+import os
+import numpy as np
+
+MAGIC = "ACTIPYFS"
+HEADER_LEN = 512
+
+class FrameStoreWriter:
+  """
+  Writes equally shaped frames (e.g. flow fields) to a FrameStore file
+  one at a time.
+
+  Frames go to a temporary file which only replaces path on close(), so
+  a half-written store is never picked up by a reader.
+  """
+
+  def __init__(self, path, dtype=np.float32, meta=None):
+    self.path = path
+    self.dtype = np.dtype(dtype)
+    self.meta = meta or {}
+    self.frame_shape = None
+    self.count = 0
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+      os.makedirs(directory)
+
+    self.tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    self.file = open(self.tmp_path, 'wb')
+    self.file.write(b'\0' * HEADER_LEN)
+
+  def append(self, frame):
+    frame = np.ascontiguousarray(frame, dtype=self.dtype)
+    if self.frame_shape is None:
+      self.frame_shape = frame.shape
+    elif frame.shape != self.frame_shape:
+      raise ValueError("Frame of shape %s doesn't match store shape %s" %
+                       (frame.shape, self.frame_shape))
+
+    self.file.write(frame.tobytes())
+    self.count += 1
+
+  def close(self):
+    header = json.dumps({
+      'dtype': self.dtype.str,
+      'shape': [self.count] + list(self.frame_shape or ()),
+      'meta': self.meta,
+    })
+    header = MAGIC + header
+    if len(header) > HEADER_LEN:
+      self.abort()
+      raise ValueError("FrameStore header too long")
+
+    self.file.seek(0)
+    self.file.write(header.ljust(HEADER_LEN).encode('ascii'))
+    self.file.close()
+    os.rename(self.tmp_path, self.path)
+
+  def abort(self):
+    self.file.close()
+    if os.path.exists(self.tmp_path):
+      os.remove(self.tmp_path)
+
+class FrameStore:
+  """
+  Read-only, memory-mapped view of a file written by FrameStoreWriter.
+
+  Frames are only paged in from disk when they are accessed.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    with open(path, 'rb') as f:
+      header = f.read(HEADER_LEN).decode('ascii')
+
+    if not header.startswith(MAGIC):
+      raise ValueError("%s is not a FrameStore" % (path,))
+
+    header = json.loads(header[len(MAGIC):].rstrip('\0 '))
+    self.dtype = np.dtype(str(header['dtype']))
+    self.shape = tuple(header['shape'])
+    self.meta = header['meta']
+
+    if self.shape[0]:
+      self.frames = np.memmap(path, self.dtype, 'r', offset=HEADER_LEN,
+                              shape=self.shape)
+    else:
+      self.frames = np.empty(self.shape, self.dtype)
+
+  def __len__(self):
+    return self.shape[0]
+
+  def __getitem__(self, i):
+    return self.frames[i]
+
+  def __iter__(self):
+    for i in xrange(len(self)):
+      yield self.frames[i]
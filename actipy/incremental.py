@@ -0,0 +1,73 @@
+import numpy as np
+from sklearn.decomposition import IncrementalPCA
+from sklearn.linear_model import SGDClassifier
+
+def shuffled_chunks(n, chunk_size, rng):
+  """
+  Indices of n rows, shuffled, in chunks of at most chunk_size. Each
+  chunk's indices are sorted so reading it from a memory map stays
+  mostly sequential.
+  """
+
+  order = rng.permutation(n)
+  for start in xrange(0, n, chunk_size):
+    yield np.sort(order[start:start+chunk_size])
+
+def class_weights(categories):
+  """
+  Weight of each sample that balances the classes: n_samples /
+  (n_classes * class count), scikit-learn's class_weight='balanced'.
+  The SVC's class_weight='auto' weighs classes in the same proportions
+  but normalised differently.
+  """
+
+  classes, inverse, counts = np.unique(categories, return_inverse=True,
+                                       return_counts=True)
+  weights = float(len(categories)) / (len(classes)*counts)
+  return classes, weights[inverse]
+
+def fit_incremental(feature_vectors, categories, n_components=6,
+                    chunk_size=1000, epochs=5, seed=0,
+                    classifier_params=None):
+  """
+  Fit PCA and a linear classifier to feature_vectors chunk_size rows at
+  a time, so only one chunk is ever in memory. feature_vectors is
+  usually a memory-mapped array, e.g. np.load(path, mmap_mode='r').
+
+  The PCA takes one pass over the rows, the classifier (logistic
+  regression by stochastic gradient descent) epochs shuffled passes.
+  Returns (pca, classifier), with the same transform, predict and
+  predict_proba as the PCA and SVC DissertationPredictor otherwise fits.
+  classifier_params are passed on to the SGDClassifier.
+  """
+
+  categories = np.asarray(categories)
+  n = len(feature_vectors)
+  if len(categories) != n:
+    raise ValueError("%d feature vectors but %d categories" % (
+      n, len(categories)))
+
+  # IncrementalPCA needs at least n_components rows per chunk
+  chunk_size = max(chunk_size, n_components)
+
+  # whitened so the classifier sees features of unit variance, which
+  # gradient descent needs to converge
+  pca = IncrementalPCA(n_components=n_components, whiten=True)
+  starts = range(0, n, chunk_size)
+  # a final chunk too small for the PCA is merged into the previous one
+  if len(starts) > 1 and n - starts[-1] < n_components:
+    starts.pop()
+  for start, stop in zip(starts, starts[1:] + [n]):
+    pca.partial_fit(feature_vectors[start:stop])
+
+  classes, weights = class_weights(categories)
+  classifier = SGDClassifier(**dict(dict(loss='log', random_state=seed),
+                                    **(classifier_params or {})))
+  rng = np.random.RandomState(seed)
+  for epoch in xrange(epochs):
+    for rows in shuffled_chunks(n, chunk_size, rng):
+      classifier.partial_fit(pca.transform(feature_vectors[rows]),
+                             categories[rows], classes=classes,
+                             sample_weight=weights[rows])
+
+  return pca, classifier
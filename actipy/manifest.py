@@ -0,0 +1,153 @@
+import json
+import os
+
+import numpy as np
+
+import actipy.cache as cache
+
+MANIFEST_VERSION = 1
+
+class Manifest:
+  """
+  The feature vectors of a dataset together with where they came from:
+  each video's path, content fingerprint and category, and the feature
+  extraction settings shared by all of them.
+
+  update() brings it in line with the videos currently in the dataset,
+  featurizing only new or changed videos and dropping deleted ones. A
+  renamed video keeps its features, since they're matched by content.
+  Changing the settings invalidates every row.
+
+  Stored as <path>.json, listing the videos, and <path>.npy with their
+  feature vectors, one row per video in the same order.
+  """
+
+  def __init__(self, settings):
+    # as it reads back from JSON, so settings compare equal after load
+    self.settings = json.loads(json.dumps(settings))
+    self.videos = []
+    self.features = None
+
+  @classmethod
+  def load(cls, path, settings):
+    """
+    Load the manifest saved at path. Returns an empty manifest if there
+    is none, it's unreadable or it was built with other settings.
+    """
+
+    manifest = cls(settings)
+    try:
+      with open(path + ".json") as f:
+        header = json.load(f)
+      features = np.load(path + ".npy")
+    except (IOError, ValueError):
+      return manifest
+
+    if header.get('version') != MANIFEST_VERSION or \
+        header.get('settings') != manifest.settings or \
+        len(header['videos']) != len(features):
+      return manifest
+
+    manifest.videos = header['videos']
+    manifest.features = features
+    return manifest
+
+  def save(self, path):
+    """
+    Write the manifest, replacing the files at path only once both
+    are complete.
+    """
+
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    features = self.features
+    if features is None:
+      features = np.empty((0, 0))
+
+    with open(tmp + ".npy", 'wb') as f:
+      np.save(f, features)
+    with open(tmp + ".json", 'w') as f:
+      json.dump({
+        'version': MANIFEST_VERSION,
+        'settings': self.settings,
+        'videos': self.videos,
+      }, f, indent=1, sort_keys=True)
+
+    os.rename(tmp + ".npy", path + ".npy")
+    os.rename(tmp + ".json", path + ".json")
+
+  def _fingerprint(self, path, st, old):
+    # Hashing every video on every rebuild would read the whole
+    # dataset, so trust the old fingerprint while size and mtime match.
+    if old is not None and old['size'] == st.st_size and \
+        old['mtime'] == st.st_mtime:
+      return old['fingerprint']
+    return cache.fingerprint(path)
+
+  def update(self, videos, featurize):
+    """
+    Bring the manifest up to date with videos, a list of (path,
+    category). featurize is called once with the paths that need
+    features and yields (path, feature_vector, error) for each, error
+    being None on success.
+
+    Returns the paths featurized, the paths dropped because they're no
+    longer in videos, and the paths that failed. Failed videos are left
+    out and tried again next time.
+    """
+
+    by_path = dict((v['path'], (v, row)) for row, v in enumerate(self.videos))
+    by_fingerprint = dict((v['fingerprint'], (v, row))
+                          for row, v in enumerate(self.videos))
+
+    videos = list(videos)
+    entries = []
+    rows = []
+    todo = {}
+    for path, category in videos:
+      st = os.stat(path)
+      old, row = by_path.get(path, (None, None))
+      fingerprint = self._fingerprint(path, st, old)
+      entry = {'path': path, 'category': category, 'fingerprint': fingerprint,
+               'size': st.st_size, 'mtime': st.st_mtime}
+
+      if old is None or old['fingerprint'] != fingerprint:
+        old, row = by_fingerprint.get(fingerprint, (None, None))
+      if old is None:
+        todo[path] = entry
+      else:
+        entries.append(entry)
+        rows.append(self.features[row])
+
+    added = []
+    failed = []
+    if todo:
+      for path, fv, error in featurize(sorted(todo)):
+        if error is None:
+          entries.append(todo[path])
+          rows.append(fv)
+          added.append(path)
+        else:
+          failed.append(path)
+
+    current = set(path for path, _ in videos)
+    removed = [v['path'] for v in self.videos if v['path'] not in current]
+
+    # keep the order of videos so the feature matrix is deterministic
+    order = dict((path, i) for i, (path, _) in enumerate(videos))
+    ranked = sorted(zip(entries, rows), key=lambda e: order[e[0]['path']])
+    self.videos = [video for video, _ in ranked]
+    self.features = np.array([fv for _, fv in ranked]) if ranked else None
+
+    return added, removed, failed
+
+  def training_set(self, paths):
+    """
+    Feature vectors and categories of paths, in that order. Paths the
+    manifest has no features for are skipped.
+    """
+
+    rows = dict((v['path'], row) for row, v in enumerate(self.videos))
+    known = [path for path in paths if path in rows]
+    feature_vectors = [self.features[rows[path]] for path in known]
+    categories = [self.videos[rows[path]]['category'] for path in known]
+    return feature_vectors, categories
@@ -1,18 +1,51 @@
-import cv
 import cv2
 import numpy as np
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool, cpu_count
 import actipy.cv_compat as cv_compat
+import actipy.plan as plan
+from actipy.pipeline import Pipeline
+from actipy.flow_backends import FlowBackend, SparseTracker, get_backend
 
-class Flow:
+class Flow(object):
   """
   Represents the optical flow between two frames.
+
+  The frames are only kept when they are needed for visualization, see
+  OpticalFlow's keep_frames. Flow isn't computed for frames a
+  MotionGate found static, which are gated and have no vectors.
   """
 
-  def __init__(self, vectors, curr_frame, prev_frame, curr_frame_color):
+  __slots__ = ('vectors', 'curr_frame', 'prev_frame', 'curr_frame_color',
+               'gated')
+
+  def __init__(self, vectors, curr_frame=None, prev_frame=None,
+               curr_frame_color=None, gated=False):
     self.vectors = vectors
     self.curr_frame = curr_frame
     self.prev_frame = prev_frame
     self.curr_frame_color = curr_frame_color
+    self.gated = gated
+
+  @classmethod
+  def from_vectors(cls, vectors):
+    """
+    Flow of vectors that were stored with store_vectors().
+    """
+
+    if np.isnan(vectors.flat[0]):
+      return cls(None, gated=True)
+    return cls(vectors)
+
+  def store_vectors(self, shape):
+    """
+    Vectors to store, in which gated flows are all NaN.
+    """
+
+    if self.gated:
+      return np.full(shape, np.nan, np.float32)
+    return self.vectors
 
   @staticmethod
   def draw_flow(vis, im, flow, step=16):
@@ -28,17 +61,22 @@ class Flow:
     lines = np.int32(lines)
 
     for pos,((x1,y1),(x2,y2)) in enumerate(lines):
-      cv_compat.line(vis,(x1,y1),(x2,y2), (255,255,0), 1, cv.CV_AA)
-      cv_compat.circle(vis,(x1,y1),1, (255,255,0), 1, cv.CV_AA)
+      cv_compat.line(vis,(x1,y1),(x2,y2), (255,255,0), 1, cv_compat.LINE_AA)
+      cv_compat.circle(vis,(x1,y1),1, (255,255,0), 1, cv_compat.LINE_AA)
 
     return vis
 
+  def draw(self, vis):
+    if self.vectors is None:
+      return vis
+    return self.draw_flow(vis, self.curr_frame, self.vectors)
+
   # I don't belong here
   def draw_good_features(self, vis):
     corners = cv2.goodFeaturesToTrack(self.curr_frame, 5, 0.4, 0)
     for corner in corners:
       x, y = [int(i) for i in corner[0]]
-      cv_compat.circle(vis,(x,y),1,(0,0,255), 3, cv.CV_AA)
+      cv_compat.circle(vis,(x,y),1,(0,0,255), 3, cv_compat.LINE_AA)
 
   ## EXPERIMENTAL ##
   def draw_hands(self, vis):
@@ -64,7 +102,7 @@ class Flow:
     else:
         vis = self.curr_frame
     if flow:
-      self.draw_flow(vis, self.curr_frame, self.vectors)
+      self.draw(vis)
     if good_features:
       self.draw_good_features(vis)
     if text:
@@ -72,73 +110,333 @@ class Flow:
       cv_compat.putText(vis, text, (10,h-10), cv2.FONT_HERSHEY_SIMPLEX, 1, (0,0,255))
     if display:
       cv_compat.show(title, vis)
-      if cv.WaitKey(10) == 27:
+      if cv2.waitKey(10) & 0xFF == 27:
         return
 
     return vis
 
-class OpticalFlow:
+class SparseFlow(Flow):
   """
-  Given a video file extracts the optical flow.
+  Represents the optical flow of points tracked between two frames.
+
+  points are the (N, 2) x, y positions of the points in the previous
+  frame and displacements how far they moved. dims are the (width,
+  height) of the frames. There are no dense vectors.
   """
 
-  def __init__(self, path):
-    self.path = path
+  __slots__ = ('points', 'displacements', 'dims')
 
-  def _iter_frames(self, vid):
-    vid_length = cv_compat.get_vid_length(vid)
-    prev_frame = cv_compat.get_gray_frame(vid)
-    curr_frame_color = cv_compat.get_frame(vid)
-    curr_frame = cv_compat.gray_copy(curr_frame_color)
+  def __init__(self, points, displacements, dims, curr_frame=None,
+               prev_frame=None, curr_frame_color=None):
+    Flow.__init__(self, None, curr_frame, prev_frame, curr_frame_color)
+    self.points = points
+    self.displacements = displacements
+    self.dims = dims
 
-    for i in xrange(vid_length-2):
-      yield (prev_frame, curr_frame, curr_frame_color)
-      prev_frame = curr_frame
-      curr_frame_color = cv_compat.get_frame(vid)
-      curr_frame = cv_compat.gray_copy(curr_frame_color)
+  def draw(self, vis):
+    mult = 4
 
-  def lucas_kanade(self):
-    vid = cv.CaptureFromFile(self.path)
+    ends = self.points + self.displacements*mult
+    for (x1,y1),(x2,y2) in zip(np.int32(self.points), np.int32(ends)):
+      cv_compat.line(vis,(x1,y1),(x2,y2), (255,255,0), 1, cv_compat.LINE_AA)
+      cv_compat.circle(vis,(x1,y1),1, (255,255,0), 1, cv_compat.LINE_AA)
 
-    first_frame = cv_compat.get_gray_frame(vid)
-    velx = cv.CreateImage(cv.GetSize(first_frame), cv.IPL_DEPTH_32F, 1)
-    vely = cv.CreateImage(cv.GetSize(first_frame), cv.IPL_DEPTH_32F, 1)
+    return vis
 
-    for prev_frame, curr_frame, curr_frame_color in self._iter_frames(vid):
-      cv.CalcOpticalFlowLK(prev_frame, curr_frame, (15,15), velx, vely)
-      flow = np.dstack((np.asarray(cv.GetMat(velx)), np.asarray(cv.GetMat(vely))))
-      yield Flow(flow, curr_frame, prev_frame, curr_frame_color)
+class MotionGate:
+  """
+  Cheap test for frame pairs with too little motion to be worth
+  computing optical flow for.
+
+  The absolute difference of the two grayscale frames, shrunk by scale,
+  is averaged over a cells x cells grid. A pair is static if no cell's
+  mean difference reaches threshold gray levels, so motion confined to
+  a small part of the frame still gets through.
+  """
+
+  def __init__(self, threshold=2.0, scale=0.25, cells=8):
+    self.params = dict(threshold=threshold, scale=scale, cells=cells)
+    self._last = None
+    self._last_small = None
+
+  def _shrink(self, frame):
+    w, h = cv_compat.get_dims(frame)
+    return cv_compat.resize(frame, plan.scaled_dims(w, h,
+                                                    self.params['scale']))
+
+  def is_static(self, prev_frame, curr_frame):
+    # prev_frame is usually the last call's curr_frame, so only shrink
+    # each frame once
+    if prev_frame is self._last:
+      prev_small = self._last_small
+    else:
+      prev_small = self._shrink(prev_frame)
+    curr_small = self._shrink(curr_frame)
+    self._last, self._last_small = curr_frame, curr_small
+
+    cells = self.params['cells']
+    diff = cv2.absdiff(prev_small, curr_small)
+    cell_diffs = cv2.resize(diff.astype(np.float32), (cells, cells),
+                            interpolation=cv2.INTER_AREA)
+    return cell_diffs.max() < self.params['threshold']
+
+class OpticalFlow:
+  """
+  Given a video file extracts the optical flow.
 
-  def horn_schunck(self):
-    vid = cv.CaptureFromFile(self.path)
+  Frames are resized by scale as they are decoded and only every
+  stride-th frame is used, so flow is computed between frames 0 and
+  stride, stride and 2*stride, and so on.
 
-    term_crit = (cv.CV_TERMCRIT_ITER, 100, 0)
+  If timings is a timings.Timings, the time spent decoding, converting
+  to grayscale and computing flow is added to it.
 
-    first_frame = cv_compat.get_gray_frame(vid)
-    velx = cv.CreateImage(cv.GetSize(first_frame), cv.IPL_DEPTH_32F, 1)
-    vely = cv.CreateImage(cv.GetSize(first_frame), cv.IPL_DEPTH_32F, 1)
+  Flows only carry their frames with keep_frames=True, which
+  visualization needs. Otherwise, unless reuse_buffers=False, frames
+  are decoded into and flow is written to a few buffers that are reused
+  from frame to frame, so a flow's vectors are only valid until the
+  flow after next is produced. Copy them to keep them for longer.
 
-    for prev_frame, curr_frame, curr_frame_color in self._iter_frames(vid):
-      cv.CalcOpticalFlowHS(prev_frame, curr_frame, False, velx, vely, 0.001, term_crit)
-      flow = np.dstack((np.asarray(cv.GetMat(velx)), np.asarray(cv.GetMat(vely))))
-      yield Flow(flow, curr_frame, prev_frame, curr_frame_color)
+  With a MotionGate as gate, flow is only computed for frame pairs with
+  enough motion and the rest are yielded as gated flows.
+  """
 
-  def farneback(self):
-    vid = cv2.VideoCapture(self.path)
-    flags = cv2.OPTFLOW_FARNEBACK_GAUSSIAN & cv2.OPTFLOW_USE_INITIAL_FLOW
-    for pos, (prev_frame, curr_frame, curr_frame_color) in enumerate(self._iter_frames(vid)):
-      flow = cv2.calcOpticalFlowFarneback(prev_frame, curr_frame,
-                                          pyr_scale=0.5, levels=3,
-                                          winsize=20, iterations=5,
-                                          poly_n=7, poly_sigma=1.5,
-                                          flags=flags)
-      yield Flow(flow, curr_frame, prev_frame, curr_frame_color)
+  def __init__(self, path, scale=1.0, stride=1, timings=None,
+               keep_frames=False, reuse_buffers=True, gate=None):
+    self.path = path
+    self.scale = scale
+    self.stride = stride
+    self.timings = timings
+    self.keep_frames = keep_frames
+    self.reuse_buffers = reuse_buffers and not keep_frames
+    self.gate = gate
+
+  def _timed(self, stage, func, *args):
+    if self.timings is None:
+      return func(*args)
+    return self.timings.timed(stage, func, *args)
+
+  def length(self, vid):
+    """
+    Number of flows in the video.
+    """
+
+    return (cv_compat.get_vid_length(vid)-2)//self.stride
+
+  def _buffers(self, buffers, reuse):
+    # without reuse every frame gets new buffers
+    return buffers if reuse else {}
+
+  def _read_frame(self, vid, buffers=None):
+    buffers = {} if buffers is None else buffers
+    frame = buffers['decoded'] = cv_compat.get_frame(vid,
+                                                     buffers.get('decoded'))
+    if self.scale != 1 and frame is not None:
+      w, h = cv_compat.get_dims(frame)
+      frame = buffers['resized'] = cv_compat.resize(
+        frame, plan.scaled_dims(w, h, self.scale), buffers.get('resized'))
+    return frame
+
+  def _read_gray(self, vid, buffers, gray):
+    color = self._timed('decode', self._read_frame, vid, buffers)
+    buffers[gray] = self._timed('gray', cv_compat.gray_copy, color,
+                                buffers.get(gray))
+    return buffers[gray], color
+
+  def _iter_frames(self, vid, start=0, stop=None, reuse=None):
+    """
+    Yields the frame pairs start..stop-1, where pair i is frames
+    i*stride and (i+1)*stride. Where seeking to start is inexact the
+    frames before it are decoded instead.
+
+    With reuse (by default reuse_buffers) the previous and current
+    grayscale frames alternate between two buffers, so a pair is only
+    valid until the next one is yielded.
+    """
+
+    if reuse is None:
+      reuse = self.reuse_buffers
+    if stop is None:
+      stop = self.length(vid)
+    if start:
+      cv_compat.seek_frame(vid, start*self.stride)
+
+    buffers = {}
+    curr_frame, curr_frame_color = self._read_gray(
+      vid, self._buffers(buffers, reuse), 'gray0')
+
+    for i in xrange(start, stop):
+      prev_frame = curr_frame
+      for _ in xrange(self.stride-1):
+        self._timed('decode', cv_compat.skip_frame, vid)
+      curr_frame, curr_frame_color = self._read_gray(
+        vid, self._buffers(buffers, reuse), 'gray%d' % ((i-start+1) % 2,))
+      yield (prev_frame, curr_frame, curr_frame_color)
 
+  def _backend(self, backend, params):
+    if not isinstance(backend, FlowBackend):
+      backend = get_backend(backend, **params)
+    if not isinstance(backend, FlowBackend):
+      raise ValueError("%s tracks sparse points, use tracks() instead" %
+                       (backend.name,))
+    return backend
+
+  def _gated(self, frames):
+    prev_frame, curr_frame, curr_frame_color = frames
+    if self.gate is None or not self._timed('flow', self.gate.is_static,
+                                            prev_frame, curr_frame):
+      return None
+    if self.keep_frames:
+      return Flow(None, curr_frame, prev_frame, curr_frame_color, gated=True)
+    return Flow(None, gated=True)
+
+  def _flow_pair(self, backend, frames, out=None):
+    gated = self._gated(frames)
+    if gated is not None:
+      return gated
+
+    prev_frame, curr_frame, curr_frame_color = frames
+    flow = self._timed('flow', backend.calc, prev_frame, curr_frame, out)
+    if self.keep_frames:
+      return Flow(flow, curr_frame, prev_frame, curr_frame_color)
+    return Flow(flow)
+
+  def flows(self, backend="farneback", start=0, stop=None, **params):
+    """
+    Yields the flow of every frame pair using a flow backend, given by
+    name (with params overriding its defaults) or as a FlowBackend.
+    """
+
+    backend = self._backend(backend, params)
+    backend.reset()
+    vid = cv_compat.open_vid(self.path)
+    out = [None, None]
+    for i, frames in enumerate(self._iter_frames(vid, start, stop)):
+      flow = self._flow_pair(backend, frames, out[i % 2])
+      if self.reuse_buffers and not flow.gated:
+        out[i % 2] = flow.vectors
+      yield flow
+
+  def tracks(self, tracker=None, start=0, stop=None):
+    """
+    Yields the SparseFlow of every frame pair using a
+    flow_backends.SparseTracker, by default one with default settings.
+    """
+
+    if tracker is None:
+      tracker = SparseTracker()
+    tracker.reset()
+
+    vid = cv_compat.open_vid(self.path)
+    for frames in self._iter_frames(vid, start, stop):
+      gated = self._gated(frames)
+      if gated is not None:
+        yield gated
+        continue
+
+      prev_frame, curr_frame, curr_frame_color = frames
+      points, displacements = self._timed('flow', tracker.track, prev_frame,
+                                          curr_frame)
+      dims = cv_compat.get_dims(curr_frame)
+      if self.keep_frames:
+        yield SparseFlow(points, displacements, dims, curr_frame, prev_frame,
+                         curr_frame_color)
+      else:
+        yield SparseFlow(points, displacements, dims)
+
+  def lucas_kanade(self, start=0, stop=None):
+    return self.flows("lucas_kanade", start, stop)
+
+  def horn_schunck(self, start=0, stop=None):
+    return self.flows("horn_schunck", start, stop)
+
+  def farneback(self, start=0, stop=None):
+    return self.flows("farneback", start, stop)
+
+  def pipelined(self, backend="farneback", maxsize=4, **params):
+    """
+    Flow with decoding and grayscale conversion in one thread and flow
+    in another, connected by a queue of at most maxsize frame pairs. The
+    returned Pipeline is iterated like flows() and its stats show the
+    throughput of each stage.
+
+    Frames in flight in the queue can't share buffers, so nothing is
+    reused.
+    """
+
+    backend = self._backend(backend, params)
+    backend.reset()
+    vid = cv_compat.open_vid(self.path)
+    return Pipeline(self._iter_frames(vid, reuse=False),
+                    [("flow", lambda frames: self._flow_pair(backend, frames))],
+                    maxsize, source_name="decode")
+
+  def sharded(self, backend="farneback", shard_len=50, processes=None,
+              max_buffered_mb=512, **params):
+    """
+    Same stream of flows as flows(), but the video is split into ranges
+    of shard_len frame pairs which are computed in parallel by a pool of
+    processes. Each shard seeks to its first frame, overlapping the
+    previous shard by one frame, and the results are stitched back
+    together in order.
+
+    Only the vectors come back from the workers so the flows carry no
+    frames. At most two shards per process are in flight at a time, and
+    no more than fit in max_buffered_mb of flow (but always at least
+    one), so workers can't run far ahead of the consumer and fill memory
+    with finished shards.
+    """
+
+    backend = self._backend(backend, params)
+    length = self.length(cv_compat.open_vid(self.path))
+    gate = self.gate.params if self.gate is not None else None
+    shards = [(self.path, self.scale, self.stride, backend.name,
+               backend.params, gate, start, min(start+shard_len, length))
+              for start in xrange(0, length, shard_len)]
+
+    processes = processes or cpu_count()
+    w, h = plan.vid_dims(self.path, self.scale)
+    shard_mb = shard_len*h*w*2*4 / float(1 << 20)
+    in_flight = int(max(1, min(2*processes, max_buffered_mb // shard_mb)))
+
+    shards = iter(shards)
+    pool = Pool(min(processes, in_flight))
+    try:
+      pending = deque(pool.apply_async(_flow_shard, (shard,))
+                      for shard in islice(shards, in_flight))
+      while pending:
+        vectors = pending.popleft().get()
+        for shard in islice(shards, 1):
+          pending.append(pool.apply_async(_flow_shard, (shard,)))
+        for v in vectors:
+          yield Flow.from_vectors(v)
+    finally:
+      pool.terminate()
+
+def _flow_shard(shard):
+  path, scale, stride, backend, params, gate, start, stop = shard
+  if gate is not None:
+    gate = MotionGate(**gate)
+  flows = OpticalFlow(path, scale, stride, gate=gate).flows(backend, start,
+                                                           stop, **params)
+
+  w, h = plan.vid_dims(path, scale)
+  vectors = np.empty((stop-start, h, w, 2), np.float32)
+  n = 0
+  for flow in flows:
+    vectors[n] = flow.store_vectors((h, w, 2))
+    n += 1
+  return vectors[:n]
 
 if __name__ == "__main__":
   from sys import argv
 
   path = argv[1]
-  flow_func = argv[2]
-  for flow in getattr(OpticalFlow(path), flow_func)():
+  backend = get_backend(argv[2])
+  optical_flow = OpticalFlow(path, keep_frames=True)
+  if isinstance(backend, SparseTracker):
+    flows = optical_flow.tracks(backend)
+  else:
+    flows = optical_flow.flows(backend)
+  for flow in flows:
     flow.show(flow=False)
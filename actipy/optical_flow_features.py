@@ -1,13 +1,279 @@
 import numpy as np
 import cv2
 
+
+def cell_polar(vectors, x_cells, y_cells):
+  """
+  Orientations and magnitudes of a flow field, grouped by grid cell.
+
+  vectors may be a single (H, W, 2) flow field or a stack of them with
+  any number of leading axes, e.g. (T, H, W, 2).
+
+  Pixels are laid out exactly as iterate_cells() visits them, so the
+  returned arrays have shape (..., x_cells, y_cells, pixels_per_cell).
+  Any remainder pixels that don't fill a whole cell are dropped.
+  """
+
+  lead = vectors.shape[:-3]
+  y_len, x_len = vectors.shape[-3:-1]
+  x_cl = x_len//x_cells
+  y_cl = y_len//y_cells
+
+  n = len(lead)
+  cells = vectors[..., :y_cells*y_cl, :x_cells*x_cl, :]
+  cells = cells.reshape(lead + (y_cells, y_cl, x_cells, x_cl, 2))
+  cells = cells.transpose(tuple(range(n)) + (n+2, n, n+1, n+3, n+4))
+  cells = cells.reshape(lead + (x_cells, y_cells, -1, 2))
+
+  x = cells[..., 0]
+  y = cells[..., 1]
+  orientations = np.arctan2(x, y)
+  magnitudes = np.sqrt(np.square(x) + np.square(y))
+
+  return orientations, magnitudes
+
+def _bin_indices(orientations, bins):
+  # Same binning rule as np.histogram(orientations, bins, (-pi, pi)):
+  # half-open bins except the last one, which also includes pi. Like
+  # np.histogram, edges are compared at the precision of orientations,
+  # since float32 -pi and pi lie just outside the float64 range.
+  dtype = np.result_type(-np.pi, np.pi, orientations)
+  bin_edges = np.linspace(-np.pi, np.pi, bins+1).astype(dtype)
+  indices = ((orientations + np.pi) * (bins / (2*np.pi))).astype(np.intp)
+  np.clip(indices, 0, bins-1, out=indices)
+  indices[orientations < bin_edges[indices]] -= 1
+  indices[(orientations >= bin_edges[indices+1]) & (indices != bins-1)] += 1
+  np.clip(indices, 0, bins-1, out=indices)
+  return indices
+
+def polar_hoof(orientations, magnitudes, bins, density=False):
+  """
+  HooF of every cell at once from the output of cell_polar().
+
+  Equivalent to calling np.histogram() on each cell, but the bin
+  index of every pixel is computed in one go and all cells are
+  accumulated with a single np.bincount().
+  """
+
+  bin_edges = np.linspace(-np.pi, np.pi, bins+1)
+  cell_shape = orientations.shape[:-1]
+  n_cells = int(np.prod(cell_shape))
+  indices = _bin_indices(orientations, bins)
+
+  offsets = np.arange(n_cells).reshape(cell_shape + (1,)) * bins
+  hists = np.bincount((indices + offsets).ravel(),
+                      weights=magnitudes.ravel(),
+                      minlength=n_cells*bins).reshape(cell_shape + (bins,))
+
+  if density:
+    with np.errstate(divide='ignore', invalid='ignore'):
+      hists = hists / hists.sum(-1)[..., np.newaxis] / np.diff(bin_edges)
+
+  return hists, bin_edges
+
+def polar_magnitude(magnitudes):
+  """
+  Mean flow magnitude of every cell from the output of cell_polar().
+  """
+
+  return np.nanmean(magnitudes, -1)
+
+def hoof_magnitude(vectors, bins, x_cells, y_cells, density=False):
+  """
+  Single pass equivalent of OpticalFlowFeatures.cell_hoof() followed by
+  OpticalFlowFeatures.magnitude().
+  """
+
+  orientations, magnitudes = cell_polar(vectors, x_cells, y_cells)
+  hists, bin_edges = polar_hoof(orientations, magnitudes, bins, density)
+  return hists, bin_edges, polar_magnitude(magnitudes)
+
+def batch_hoof_magnitude(vectors, bins, x_cells, y_cells, density=False,
+                         chunk_size=None):
+  """
+  HooF and flow magnitude of a (T, H, W, 2) stack of flow fields.
+
+  Returns (T, x_cells, y_cells, bins) histograms, the bin edges and
+  (T, x_cells, y_cells) magnitudes. The stack is processed chunk_size
+  frames at a time to bound the size of the temporaries, which also
+  means vectors can be a memory-mapped array larger than RAM.
+  """
+
+  length = len(vectors)
+  chunk_size = chunk_size or max(length, 1)
+
+  hists = np.empty((length, x_cells, y_cells, bins))
+  magnitudes = np.empty((length, x_cells, y_cells))
+  bin_edges = np.linspace(-np.pi, np.pi, bins+1)
+
+  for start in xrange(0, length, chunk_size):
+    stop = start+chunk_size
+    hists[start:stop], bin_edges, magnitudes[start:stop] = hoof_magnitude(
+      np.asarray(vectors[start:stop]), bins, x_cells, y_cells, density)
+
+  return hists, bin_edges, magnitudes
+
+def track_polar(points, displacements, dims, x_cells, y_cells):
+  """
+  Grid cells, orientations and magnitudes of tracked points.
+
+  points are the (N, 2) x, y positions of the points in the first frame
+  and displacements how far they moved. dims are the (width, height) of
+  the frame. Cells are numbered x_cell*y_cells + y_cell, laid out as
+  iterate_cells() lays out pixels, and points in the remainder that
+  doesn't fill a whole cell are dropped.
+  """
+
+  w, h = dims
+  x_cl = w//x_cells
+  y_cl = h//y_cells
+
+  xi = np.floor(points[:, 0] / x_cl).astype(np.intp)
+  yi = np.floor(points[:, 1] / y_cl).astype(np.intp)
+  inside = (xi >= 0) & (xi < x_cells) & (yi >= 0) & (yi < y_cells)
+
+  x = displacements[inside, 0]
+  y = displacements[inside, 1]
+  cells = xi[inside]*y_cells + yi[inside]
+  orientations = np.arctan2(x, y)
+  magnitudes = np.sqrt(np.square(x) + np.square(y))
+
+  return cells, orientations, magnitudes
+
+def track_hoof(cells, orientations, magnitudes, bins, x_cells, y_cells,
+               density=False):
+  """
+  (x_cells, y_cells, bins) HooF from the output of track_polar(). Cells
+  without any tracked points are all zeros.
+  """
+
+  bin_edges = np.linspace(-np.pi, np.pi, bins+1)
+  indices = _bin_indices(orientations, bins)
+  hists = np.bincount(cells*bins + indices, weights=magnitudes,
+                      minlength=x_cells*y_cells*bins)
+  hists = hists.reshape(x_cells, y_cells, bins)
+
+  if density:
+    sums = hists.sum(-1)[..., np.newaxis]
+    hists = np.where(sums > 0, hists / np.where(sums > 0, sums, 1), 0)
+    hists /= np.diff(bin_edges)
+
+  return hists, bin_edges
+
+def track_magnitude(cells, magnitudes, x_cells, y_cells):
+  """
+  (x_cells, y_cells) mean magnitude from the output of track_polar().
+  Cells without any tracked points are zero.
+  """
+
+  n_cells = x_cells*y_cells
+  totals = np.bincount(cells, weights=magnitudes, minlength=n_cells)
+  counts = np.bincount(cells, minlength=n_cells)
+  means = totals / np.maximum(counts, 1)
+  return means.reshape(x_cells, y_cells)
+
+def track_hoof_magnitude(points, displacements, dims, bins, x_cells, y_cells,
+                         density=False):
+  """
+  HooF and magnitude of tracked points, shaped like hoof_magnitude()'s.
+  """
+
+  cells, orientations, magnitudes = track_polar(points, displacements, dims,
+                                                x_cells, y_cells)
+  hists, bin_edges = track_hoof(cells, orientations, magnitudes, bins,
+                                x_cells, y_cells, density)
+  return hists, bin_edges, track_magnitude(cells, magnitudes, x_cells, y_cells)
+
+def grid_edges(length, cells):
+  """
+  Boundaries of cells equal-as-possible cells covering length pixels.
+  Where cells divides length they are the cells iterate_cells() uses.
+  """
+
+  return (np.arange(cells+1)*length)//cells
+
+class IntegralHoof:
+  """
+  Integral histogram of a flow field: for every pixel, the HooF and
+  pixel count of the rectangle between it and the top-left corner.
+
+  Built once per flow in a single pass, it answers the HooF and mean
+  magnitude of any rectangle in constant time, so any number of grids
+  (including ones that don't divide the frame and whole spatial
+  pyramids) cost about the same as a single one. Pixels with NaN flow
+  are left out, as np.histogram and np.nanmean would.
+  """
+
+  def __init__(self, vectors, bins):
+    self.bins = bins
+    self.bin_edges = np.linspace(-np.pi, np.pi, bins+1)
+    self.height, self.width = vectors.shape[:2]
+
+    x = vectors[..., 0]
+    y = vectors[..., 1]
+    orientations = np.arctan2(x, y).ravel()
+    magnitudes = np.sqrt(np.square(x) + np.square(y)).ravel()
+    valid = ~np.isnan(magnitudes)
+    indices = _bin_indices(np.where(valid, orientations, 0), bins)
+
+    # one channel per bin holding the pixel's magnitude if it falls in
+    # that bin, then a channel counting valid pixels
+    pixels = np.zeros((self.height*self.width, bins+1))
+    positions = np.arange(len(pixels))
+    pixels[positions, indices] = np.where(valid, magnitudes, 0)
+    pixels[positions, bins] = valid
+
+    table = np.zeros((self.height+1, self.width+1, bins+1))
+    table[1:, 1:] = pixels.reshape(self.height, self.width, bins+1)
+
+    np.cumsum(table, 0, out=table)
+    np.cumsum(table, 1, out=table)
+    self.table = table
+
+  def _sums(self, xs, ys):
+    t = self.table[ys][:, xs]
+    return t[1:, 1:] - t[:-1, 1:] - t[1:, :-1] + t[:-1, :-1]
+
+  def _features(self, sums, density):
+    hists = sums[..., :-1]
+    counts = sums[..., -1]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+      magnitudes = hists.sum(-1) / counts
+      if density:
+        hists = hists / hists.sum(-1)[..., np.newaxis] / np.diff(self.bin_edges)
+
+    return hists, self.bin_edges, magnitudes
+
+  def rect(self, x0, y0, x1, y1, density=False):
+    """
+    HooF, bin edges and mean magnitude of the pixels x0 <= x < x1,
+    y0 <= y < y1.
+    """
+
+    return self._features(self._sums(np.array([x0, x1]),
+                                     np.array([y0, y1]))[0, 0], density)
+
+  def grid(self, x_cells, y_cells, density=False):
+    """
+    (x_cells, y_cells, bins) HooF, bin edges and (x_cells, y_cells)
+    mean magnitudes of a grid covering the whole frame, with cell
+    boundaries from grid_edges(). Where the grid divides the frame this
+    is what hoof_magnitude() computes.
+    """
+
+    sums = self._sums(grid_edges(self.width, x_cells),
+                      grid_edges(self.height, y_cells))
+    return self._features(sums.transpose(1, 0, 2), density)
+
+
 class OpticalFlowFeatures:
   """
   Extracts features from an optical flow.
 
   This code is optimized for understanding rather than performance.
   As a result there is much recalculation across the different
-  feature extractors.
+  feature extractors. Use hoof_magnitude() when speed matters.
   """
 
   def __init__(self, flow):
@@ -86,3 +352,11 @@ class OpticalFlowFeatures:
       cell_magnitudes[xi,yi] = np.nanmean(np.sqrt(np.square(x) + np.square(y)))
 
     return cell_magnitudes
+
+  def hoof_magnitude(self, bins, x_cells, y_cells, density=False):
+    """
+    Calculate HooF and flow magnitude across grid cell defined by x_cells
+    and y_cells in a single vectorized pass.
+    """
+
+    return hoof_magnitude(self.flow.vectors, bins, x_cells, y_cells, density)
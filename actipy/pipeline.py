@@ -0,0 +1,138 @@
+import sys
+import threading
+import time
+from Queue import Queue, Empty, Full
+
+class StageStats:
+  """
+  Throughput counters for one pipeline stage.
+
+  busy is the time spent doing the stage's own work, waiting the time
+  spent blocked on a full output queue or an empty input queue. The
+  stage with the lowest fps and least waiting is the bottleneck.
+  """
+
+  def __init__(self, name):
+    self.name = name
+    self.items = 0
+    self.busy = 0.0
+    self.waiting = 0.0
+
+  def fps(self):
+    return self.items / self.busy if self.busy else float('nan')
+
+  def __str__(self):
+    return "%s: %d items, %.1f fps, %.2fs busy, %.2fs waiting" % (
+      self.name, self.items, self.fps(), self.busy, self.waiting)
+
+class _Failure:
+  def __init__(self, exc_info):
+    self.exc_info = exc_info
+
+_DONE = object()
+
+class Pipeline:
+  """
+  Runs a source iterable and a chain of (name, function) stages each in
+  their own thread, connected by queues of at most maxsize items.
+  Iterating the pipeline yields the output of the last stage in order.
+
+  This only pays off when the stages release the GIL, as OpenCV and
+  most of NumPy do. The bounded queues cap how many items are in flight
+  and so how much memory the pipeline uses.
+  """
+
+  def __init__(self, source, stages, maxsize=4, source_name="source"):
+    self.source = source
+    self.stages = stages
+    self.maxsize = maxsize
+    self.source_stats = StageStats(source_name) if source_name else None
+    self.stats = ([self.source_stats] if self.source_stats else []) + [
+      StageStats(name) for name, _ in stages]
+    self._stop = threading.Event()
+
+  def _put(self, queue, item, stats):
+    start = time.time()
+    while not self._stop.is_set():
+      try:
+        queue.put(item, timeout=0.1)
+        break
+      except Full:
+        pass
+    if stats:
+      stats.waiting += time.time()-start
+
+  def _get(self, queue, stats):
+    start = time.time()
+    while not self._stop.is_set():
+      try:
+        item = queue.get(timeout=0.1)
+        break
+      except Empty:
+        pass
+    else:
+      item = _DONE
+    if stats:
+      stats.waiting += time.time()-start
+    return item
+
+  def _run_source(self, out, stats):
+    try:
+      items = iter(self.source)
+      while not self._stop.is_set():
+        start = time.time()
+        try:
+          item = next(items)
+        except StopIteration:
+          break
+        if stats:
+          stats.busy += time.time()-start
+          stats.items += 1
+        self._put(out, item, stats)
+    except Exception:
+      self._put(out, _Failure(sys.exc_info()), None)
+      return
+    self._put(out, _DONE, None)
+
+  def _run_stage(self, func, inp, out, stats):
+    while True:
+      item = self._get(inp, stats)
+      if item is _DONE or isinstance(item, _Failure):
+        self._put(out, item, None)
+        return
+
+      start = time.time()
+      try:
+        item = func(item)
+      except Exception:
+        self._put(out, _Failure(sys.exc_info()), None)
+        return
+      stats.busy += time.time()-start
+      stats.items += 1
+      self._put(out, item, stats)
+
+  def __iter__(self):
+    queues = [Queue(self.maxsize) for _ in xrange(len(self.stages)+1)]
+    stage_stats = self.stats[1:] if self.source_stats else self.stats
+    threads = [threading.Thread(target=self._run_source,
+                                args=(queues[0], self.source_stats))]
+    for i, (name, func) in enumerate(self.stages):
+      threads.append(threading.Thread(target=self._run_stage,
+        args=(func, queues[i], queues[i+1], stage_stats[i])))
+
+    for thread in threads:
+      thread.daemon = True
+      thread.start()
+
+    try:
+      while True:
+        item = self._get(queues[-1], None)
+        if item is _DONE:
+          break
+        if isinstance(item, _Failure):
+          raise item.exc_info[0], item.exc_info[1], item.exc_info[2]
+        yield item
+    finally:
+      self._stop.set()
+      for thread in threads:
+        thread.join()
@@ -1,8 +1,14 @@
+import os
+from collections import namedtuple
 import cv2
 import cv_compat
 
 # Utils to help choose a good set of parameters for feature extraction
 
+VideoInfo = namedtuple('VideoInfo', ['width', 'height', 'length', 'fps'])
+
+_probes = {}
+
 def factors(n):    
   return set(reduce(list.__add__, 
     ([i, n//i] for i in range(1, int(n**0.5) + 1) if n % i == 0)))
@@ -14,16 +20,42 @@ def closest_factor(p, q):
 def fit_cells(width, height, x_guess, y_guess):
   return (closest_factor(x_guess, width), closest_factor(y_guess, height))
 
-def vid_dims(path):
-  vid = cv_compat.open_vid(path)
-  im = cv_compat.get_gray_frame(vid)
-  h,w = im.shape[:2]
-  return w, h
+def scaled_dims(width, height, scale):
+  """
+  Frame dimensions after OpticalFlow resizes frames by scale.
+  """
+
+  return (max(1, int(round(width*scale))), max(1, int(round(height*scale))))
+
+def probe(path):
+  """
+  Opens a video once to read its dimensions, frame count and fps.
+
+  Results are cached on path, size and mtime so planning a video only
+  opens it the first time.
+  """
+
+  st = os.stat(path)
+  key = (os.path.abspath(path), st.st_size, st.st_mtime)
+  if key not in _probes:
+    vid = cv_compat.open_vid(path)
+    width, height = cv_compat.get_vid_dims(vid)
+    if not width or not height:
+      # not every backend reports dimensions without decoding
+      width, height = cv_compat.get_dims(cv_compat.get_frame(vid))
+    _probes[key] = VideoInfo(width, height, cv_compat.get_vid_length(vid),
+                             cv_compat.get_vid_fps(vid))
+    vid.release()
+
+  return _probes[key]
+
+def vid_dims(path, scale=1.0):
+  info = probe(path)
+  return scaled_dims(info.width, info.height, scale)
 
 def vid_length(path):
-  vid = cv_compat.open_vid(path)
-  return cv_compat.get_vid_length(vid)
+  return probe(path).length
 
-def good_cells(path, x_guess, y_guess):
-  width, height = vid_dims(path)
+def good_cells(path, x_guess, y_guess, scale=1.0):
+  width, height = vid_dims(path, scale)
   return fit_cells(width, height, x_guess, y_guess)
\ No newline at end of file
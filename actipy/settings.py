@@ -0,0 +1,14 @@
+from actipy.flow_backends import FARNEBACK_PARAMS
+
+# Feature extraction settings the training features are computed with,
+# shared by train.py and DissertationPredictor. Kept apart from both so
+# importing them doesn't pull in the classifiers or plotting.
+DEFAULT_SETTINGS = {
+  'grid': (3, 3),
+  'bins': 8,
+  'density': True,
+  'scale': 1.0,
+  'stride': 1,
+  'flow': 'farneback',
+  'flow_params': FARNEBACK_PARAMS,
+}
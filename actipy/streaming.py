@@ -0,0 +1,163 @@
+import time
+from collections import namedtuple
+
+import numpy as np
+
+import actipy.cv_compat as cv_compat
+import actipy.plan as plan
+from actipy.flow_backends import SparseTracker, get_backend
+from actipy.optical_flow_features import hoof_magnitude, track_hoof_magnitude
+from actipy.window_stats import WindowStats
+
+StreamPrediction = namedtuple('StreamPrediction',
+  ['timestamp', 'frame', 'prediction', 'latency', 'dropped'])
+
+def replay(path, fps=None):
+  """
+  Yields (timestamp, frame) from a video file as if it were a live
+  source running at fps, by default the video's own frame rate.
+
+  The timestamp is when the frame became available. A consumer that
+  falls behind gets frames late rather than slowing the source down,
+  just like a camera.
+  """
+
+  fps = fps or plan.probe(path).fps
+  vid = cv_compat.open_vid(path)
+  start = time.time()
+
+  i = 0
+  while True:
+    due = start + i/float(fps)
+    wait = due - time.time()
+    if wait > 0:
+      time.sleep(wait)
+
+    frame = cv_compat.get_frame(vid)
+    if frame is None:
+      break
+    yield due, frame
+    i += 1
+
+def capture(vid):
+  """
+  Yields (timestamp, frame) from an open capture, e.g. a camera.
+  """
+
+  while True:
+    frame = cv_compat.get_frame(vid)
+    if frame is None:
+      break
+    yield time.time(), frame
+
+class StreamingPredictor:
+  """
+  Classifies a stream of frames under a per-frame latency budget.
+
+  predictor is anything with a classify(fv) method, such as a
+  DissertationPredictor. Frames that are already older than
+  latency_budget seconds when the predictor gets to them are dropped
+  without computing their flow, so a predictor that falls behind
+  catches up with the source instead of lagging further and further.
+  Flow is then computed between the last frame used and the next one.
+
+  Like OpticalFlow, only every stride-th frame is used, so flow is
+  computed between frames stride apart and a prediction is made every
+  stride frames, matching the windows of a predictor trained with that
+  stride. Frames skipped for the stride don't count as dropped.
+
+  flow_backend may also be sparse_lk, in which case the features come
+  from tracked corners as in VideoFeatures.
+  """
+
+  def __init__(self, predictor, x_cells, y_cells, window_size,
+               latency_budget, bins=8, density=True, scale=1.0,
+               flow_backend="farneback", flow_params=None, stride=1):
+    self.predictor = predictor
+    self.x_cells = x_cells
+    self.y_cells = y_cells
+    self.window_size = window_size
+    self.latency_budget = latency_budget
+    self.bins = bins
+    self.density = density
+    self.scale = scale
+    self.stride = stride
+    self.backend = get_backend(flow_backend, **(flow_params or {}))
+
+  def _gray(self, frame):
+    if self.scale != 1:
+      w, h = cv_compat.get_dims(frame)
+      frame = cv_compat.resize(frame, plan.scaled_dims(w, h, self.scale))
+    return cv_compat.gray_copy(frame)
+
+  def predict(self, frames):
+    """
+    Yields a StreamPrediction for every frame processed once the window
+    is full. frames is an iterable of (timestamp, frame) such as
+    replay() or capture(). dropped counts the frames dropped so far.
+    """
+
+    stats = WindowStats((self.x_cells, self.y_cells, self.bins),
+                        self.window_size)
+    self.backend.reset()
+    prev_frame = None
+    flow = None
+    dropped = 0
+
+    for pos, (timestamp, frame) in enumerate(frames):
+      if pos % self.stride:
+        continue
+      if prev_frame is not None and \
+          time.time() - timestamp > self.latency_budget:
+        dropped += 1
+        continue
+
+      curr_frame = self._gray(frame)
+      if prev_frame is None:
+        prev_frame = curr_frame
+        continue
+
+      if isinstance(self.backend, SparseTracker):
+        points, displacements = self.backend.track(prev_frame, curr_frame)
+        hist, bin_edges, magnitude = track_hoof_magnitude(
+          points, displacements, cv_compat.get_dims(curr_frame), self.bins,
+          self.x_cells, self.y_cells, self.density)
+      else:
+        # the flow is done with before the next one, so reuse its buffer
+        flow = self.backend.calc(prev_frame, curr_frame, flow)
+        hist, bin_edges, magnitude = hoof_magnitude(
+          flow, self.bins, self.x_cells, self.y_cells, self.density)
+      prev_frame = curr_frame
+
+      stats.push(hist, magnitude)
+      if stats.count < self.window_size:
+        continue
+
+      avg_hists, bin_edges, avg_magnitudes, variances = stats.summary(bin_edges)
+      fv = np.concatenate((avg_hists.flatten(), avg_magnitudes.flatten(),
+                          variances.flatten()))
+      prediction = self.predictor.classify(fv)
+
+      yield StreamPrediction(timestamp, pos, prediction,
+                             time.time() - timestamp, dropped)
+
+if __name__ == "__main__":
+  from sys import argv
+  from actipy.dissertation import DissertationPredictor
+
+  model_path = argv[1]
+  test_path = argv[2]
+  fps = float(argv[3])
+  window_size = int(argv[4])
+  latency_budget = float(argv[5])
+
+  dp = DissertationPredictor.load(model_path)
+  settings = dp.settings
+  x_cells, y_cells = plan.good_cells(test_path, settings['grid'][0],
+                                     settings['grid'][1], settings['scale'])
+  sp = StreamingPredictor(dp, x_cells, y_cells, window_size, latency_budget,
+                          settings['bins'], settings['density'],
+                          settings['scale'], settings['flow'],
+                          settings['flow_params'], settings['stride'])
+  for p in sp.predict(replay(test_path, fps)):
+    print "%.3f frame %d: %s (latency %.3fs, %d dropped)" % p
@@ -0,0 +1,157 @@
+import sys
+import threading
+import time
+from datetime import timedelta
+
+# Stages of feature extraction, in the order they run on a frame
+STAGES = ['decode', 'gray', 'flow', 'hoof', 'magnitude', 'summarise']
+
+class Timings:
+  """
+  Cumulative and per-frame time spent in each stage of feature
+  extraction, with the frame rate and time remaining.
+
+  Stages add their time with timed() or add() and frame() marks the
+  end of every frame. At most every interval seconds a one line report
+  is written to out (stdout by default) and callback, if given, is
+  called with the Timings. quiet=True turns the report off but still
+  calls callback, which is what batch jobs with many workers want.
+
+  Stages may run in different threads, as long as each stage only runs
+  in one of them; add() and frame() take a lock so time added while a
+  frame ends isn't lost.
+  """
+
+  def __init__(self, total=None, interval=1.0, quiet=False, callback=None,
+               out=None):
+    self.total = total
+    self.interval = interval
+    self.quiet = quiet
+    self.callback = callback
+    self.out = out or sys.stdout
+    self._lock = threading.Lock()
+    self.start()
+
+  def start(self):
+    """
+    Reset the timings, e.g. before extracting features again.
+    """
+
+    self.totals = dict((stage, 0.0) for stage in STAGES)
+    self.last = {}
+    self.frames = 0
+    self._current = {}
+    self._start = time.time()
+    self._reported = self._start
+    self._reporting = False
+
+  def add(self, stage, seconds):
+    with self._lock:
+      self.totals[stage] = self.totals.get(stage, 0.0) + seconds
+      self._current[stage] = self._current.get(stage, 0.0) + seconds
+
+  def timed(self, stage, func, *args):
+    """
+    Call func(*args), adding the time it takes to stage.
+    """
+
+    start = time.time()
+    result = func(*args)
+    self.add(stage, time.time() - start)
+    return result
+
+  def timed_iter(self, stage, iterable):
+    """
+    Iterate iterable, adding the time each item takes to stage.
+    """
+
+    iterator = iter(iterable)
+    while True:
+      start = time.time()
+      try:
+        item = next(iterator)
+      except StopIteration:
+        return
+      self.add(stage, time.time() - start)
+      yield item
+
+  def frame(self, n=1):
+    """
+    Mark the end of n frames. Time added since the last call is their
+    per-frame time.
+    """
+
+    with self._lock:
+      self.frames += n
+      current, self._current = self._current, {}
+    self.last = dict((stage, seconds/n) for stage, seconds in current.items())
+
+    now = time.time()
+    if now - self._reported >= self.interval:
+      self._reported = now
+      self.report()
+
+  def elapsed(self):
+    return time.time() - self._start
+
+  def fps(self):
+    elapsed = self.elapsed()
+    return self.frames / elapsed if elapsed else float('nan')
+
+  def eta(self):
+    """
+    Seconds until total frames are done, or None if total is unknown.
+    """
+
+    fps = self.fps()
+    if self.total is None or not fps > 0:
+      return None
+    return max(self.total - self.frames, 0) / fps
+
+  def per_frame(self):
+    """
+    Mean time per frame of every stage.
+    """
+
+    return dict((stage, seconds/self.frames if self.frames else float('nan'))
+                for stage, seconds in self.totals.items())
+
+  def report(self):
+    if self.callback is not None:
+      self.callback(self)
+    if self.quiet:
+      return
+
+    if self.out.isatty():
+      self.out.write("\r%s" % (self,))
+      self._reporting = True
+    else:
+      self.out.write("%s\n" % (self,))
+    self.out.flush()
+
+  def finish(self):
+    """
+    Report the final timings regardless of the interval.
+    """
+
+    self.report()
+    if self._reporting:
+      self.out.write("\n")
+      self._reporting = False
+
+  def __str__(self):
+    if self.total is None:
+      progress = "%d frames" % (self.frames,)
+    else:
+      progress = "%d of %d frames" % (self.frames, self.total)
+
+    eta = self.eta()
+    if eta is not None:
+      progress += ", ETA %s" % (timedelta(seconds=int(eta)),)
+
+    per_frame = self.per_frame()
+    stages = ", ".join("%s %.1fms" % (stage, 1000*per_frame[stage])
+                       for stage in STAGES if self.totals[stage])
+
+    return "%s, %.1f fps%s" % (progress, self.fps(),
+                               " (%s)" % (stages,) if stages else "")
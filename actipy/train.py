@@ -1,111 +1,172 @@
-from sys import argv, exit
+from sys import argv, exit, stderr
 from re import match
 from collections import defaultdict
+from multiprocessing import Pool
+from functools import partial
 import os
 import hashlib
+import traceback
 
 import numpy as np
 from sklearn.decomposition import PCA, FastICA, NMF
 from bokeh.plotting import *
 
 from actipy.video_features import VideoFeatures
+from actipy.settings import DEFAULT_SETTINGS
+from actipy.manifest import Manifest
 from actipy.plan import good_cells
 
-path = argv[1]
-output = argv[2]
-
 TRAINING_LEN = 1000 # per class
 TESTING_LEN = 5 # per class
 
-dataset = defaultdict(list)
+def load_dataset(path):
+  dataset = defaultdict(list)
+
+  for f in sorted(os.listdir(path)):
+    if f.endswith(".mp4"):
+      category = match("[a-z]+", f).group()
+      dataset[category].append(os.path.join(path, f))
 
-for f in os.listdir(path):
-  if f.endswith(".mp4"):
-    category = match("[a-z]+", f).group()
-    dataset[category].append(os.path.join(path, f))
+  return dataset
 
-def calc_feature_vector(path):
-  x_cells, y_cells = good_cells(path, 3, 3)
-  avg_hists, bin_edges, avg_magnitudes, variances, flow = VideoFeatures(path).calc_window_features(x_cells, y_cells, None)
+def calc_feature_vector(path, quiet=False):
+  # DissertationPredictor's settings, which are stored in the dataset
+  # manifest, so changing them rebuilds every row
+  settings = DEFAULT_SETTINGS
+  x_cells, y_cells = good_cells(path, *settings['grid'], scale=settings['scale'])
+  avg_hists, bin_edges, avg_magnitudes, variances, flow = VideoFeatures(path, cache_features=True, bins=settings['bins'], density=settings['density'], scale=settings['scale'], stride=settings['stride'], flow_backend=settings['flow'], flow_params=settings['flow_params'], quiet=quiet).calc_window_features(x_cells, y_cells, None)
   fv = np.concatenate((avg_hists.flatten(), avg_magnitudes.flatten(), variances.flatten()))
 
   return fv
 
-def calc_feature_vectors(dataset):
-  feature_vectors = []
+def try_calc_feature_vector(path, quiet=False):
+  """
+  calc_feature_vector() that returns the traceback instead of raising,
+  so one bad video doesn't take down a whole pool.
+  """
 
-  for category, paths in dataset.items():
-    for path in paths[:TRAINING_LEN]:
-      feature_vectors.append(calc_feature_vector(path))
+  try:
+    return calc_feature_vector(path, quiet), None
+  except Exception:
+    return None, traceback.format_exc()
 
-  return feature_vectors
+def training_paths(dataset):
+  paths = []
 
-def get_categories(dataset):
-  categories = []
+  for category, category_paths in dataset.items():
+    paths.extend(category_paths[:TRAINING_LEN])
 
-  for category, paths in dataset.items():
-    for path in paths[:TRAINING_LEN]:
-      categories.append(category)
+  return paths
 
-  return categories
+def training_videos(dataset):
+  """
+  (path, category) of every training video.
+  """
 
-feature_path = "feature_vectors_%s.npy" % (hashlib.md5(path).hexdigest(),)
-try:
-  feature_vectors = np.load(feature_path)
-  raise
-except:
-  feature_vectors = calc_feature_vectors(dataset)
-  np.save(feature_path, feature_vectors)
+  videos = []
+
+  for category, category_paths in dataset.items():
+    videos.extend((path, category) for path in category_paths[:TRAINING_LEN])
+
+  return videos
+
+def featurize(paths, processes=1):
+  """
+  Yields (path, feature_vector, error) for paths, in order.
+
+  With processes > 1 the videos are spread across a pool of that many
+  processes, which don't report their progress. Videos that fail are
+  reported on stderr and yielded with their traceback as error.
+  """
+
+  if processes > 1:
+    pool = Pool(processes)
+    results = pool.imap(partial(try_calc_feature_vector, quiet=True), paths)
+  else:
+    pool = None
+    results = (try_calc_feature_vector(path) for path in paths)
+
+  for path, (fv, error) in zip(paths, results):
+    if error is not None:
+      print >> stderr, "Failed to extract features for %s:\n%s" % (path, error)
+    yield path, fv, error
+
+  if pool is not None:
+    pool.close()
+    pool.join()
+
+def update_manifest(path, dataset, processes=1):
+  """
+  Brings the manifest of the dataset at path up to date, featurizing
+  only videos that are new or changed since the last run. Returns the
+  training feature vectors and their categories.
+  """
+
+  manifest_path = "dataset_%s" % (hashlib.md5(path).hexdigest(),)
+  manifest = Manifest.load(manifest_path, DEFAULT_SETTINGS)
+  added, removed, failed = manifest.update(
+    training_videos(dataset), partial(featurize, processes=processes))
+  manifest.save(manifest_path)
 
-category_path = "category_%s.npy" % (hashlib.md5(path).hexdigest(),)
-try:
-  categories = np.load(category_path)
-  raise
-except:
-  categories = get_categories(dataset)
+  print "Dataset manifest: %d featurized, %d removed, %d failed, %d total" % (
+    len(added), len(removed), len(failed), len(manifest.videos))
+
+  return manifest.training_set(training_paths(dataset))
+
+if __name__ == "__main__":
+  path = argv[1]
+  output = argv[2]
+  processes = int(argv[3]) if len(argv) > 3 else 1
+
+  dataset = load_dataset(path)
+
+  feature_path = "feature_vectors_%s.npy" % (hashlib.md5(path).hexdigest(),)
+  category_path = "category_%s.npy" % (hashlib.md5(path).hexdigest(),)
+  feature_vectors, categories = update_manifest(path, dataset, processes)
+  # what DissertationPredictor trains on
+  np.save(feature_path, feature_vectors)
   np.save(category_path, categories)
 
+  ### This PCA just for graphing purposes ###
+  pca = PCA(n_components=2)
+  pca_feature_vectors = pca.fit_transform(feature_vectors)
+
+  colors = ["#1f77b4", "#ff7f0e", "#2ca02c", "#d62728", "#9467bd",
+  "#8c564b", "#e377c2", "#7f7f7f", "#bcbd22", "#17becf"]
+
+  # assume same number of examples in each class
+  category_length = len(pca_feature_vectors)/len(dataset)
 
-### This PCA just for graphing purposes ###
-pca = PCA(n_components=2)
-pca_feature_vectors = pca.fit_transform(feature_vectors)
-
-colors = ["#1f77b4", "#ff7f0e", "#2ca02c", "#d62728", "#9467bd",
-"#8c564b", "#e377c2", "#7f7f7f", "#bcbd22", "#17becf"]
-
-# assume same number of examples in each class
-category_length = len(pca_feature_vectors)/len(dataset)
-
-output_file(output)
-
-hold()
-base = 0
-for pos, category in enumerate(dataset):
-  print category
-  cat_len = min(len(dataset[category]), TRAINING_LEN)
-  print cat_len
-  scatter(pca_feature_vectors[base:base+cat_len].T[0], pca_feature_vectors[base:base+cat_len].T[1],
-    fill_color=colors[pos], legend=category)
-  base += cat_len
-show()
-
-exit()
-
-# Classification PCA
-pca = PCA(n_components=6)
-pca_feature_vectors = pca.fit_transform(feature_vectors)
-
-# Construct SVM
-from sklearn import svm
-classifier = svm.SVC(probability=True)
-categories = np.asarray([[i]*TRAINING_LEN for i in range(len(dataset))]).flatten()
-classifier.fit(pca_feature_vectors, categories)
-
-# Predict categories
-for category, paths in dataset.items():
-  for path in paths[TRAINING_LEN:TRAINING_LEN+TESTING_LEN]:
-    fv = calc_feature_vector(path)
-    predictions = classifier.predict_proba(pca.transform(fv))[0]
-    print [(dataset.keys()[pos], p) for pos,p in enumerate(predictions)]
-    #prediction = dataset.keys()[classifier.predict(pca.transform(fv))[0]]
-    #print "%s is predicted to be a <%s> sample." % (path, prediction)
+  output_file(output)
+
+  hold()
+  base = 0
+  for pos, category in enumerate(dataset):
+    print category
+    cat_len = list(categories).count(category)
+    print cat_len
+    scatter(pca_feature_vectors[base:base+cat_len].T[0], pca_feature_vectors[base:base+cat_len].T[1],
+      fill_color=colors[pos], legend=category)
+    base += cat_len
+  show()
+
+  exit()
+
+  # Classification PCA
+  pca = PCA(n_components=6)
+  pca_feature_vectors = pca.fit_transform(feature_vectors)
+
+  # Construct SVM
+  from sklearn import svm
+  classifier = svm.SVC(probability=True)
+  categories = np.asarray([[i]*TRAINING_LEN for i in range(len(dataset))]).flatten()
+  classifier.fit(pca_feature_vectors, categories)
+
+  # Predict categories
+  for category, paths in dataset.items():
+    for path in paths[TRAINING_LEN:TRAINING_LEN+TESTING_LEN]:
+      fv = calc_feature_vector(path)
+      predictions = classifier.predict_proba(pca.transform(fv))[0]
+      print [(dataset.keys()[pos], p) for pos,p in enumerate(predictions)]
+      #prediction = dataset.keys()[classifier.predict(pca.transform(fv))[0]]
+      #print "%s is predicted to be a <%s> sample." % (path, prediction)
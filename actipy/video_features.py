@@ -1,82 +1,428 @@
-from actipy.optical_flow import OpticalFlow 
-from actipy.optical_flow_features import OpticalFlowFeatures
+from actipy.optical_flow import OpticalFlow, Flow, MotionGate
+from actipy.flow_backends import SparseTracker, get_backend
+from actipy.optical_flow_features import batch_hoof_magnitude, cell_polar, \
+  polar_hoof, polar_magnitude, track_polar, track_hoof, track_magnitude, \
+  IntegralHoof
+import os
 import numpy as np
 import actipy.plan as plan
-from actipy.progress_bar import ProgressBar
+from actipy.timings import Timings
+from actipy.window_stats import WindowStats, MultiWindowStats, normalise
+from actipy.frame_store import FrameStore, FrameStoreWriter
+from actipy.pipeline import Pipeline
+import actipy.cache as cache
 
-import hashlib
+from itertools import islice
 
 class VideoFeatures:
   """
   Given a video file extracts features.
+
+  With persist=True the optical flow vectors are cached to a FrameStore
+  under models/, stored as persist_dtype (e.g. np.float16 to halve the
+  cache size), and replayed on later runs instead of being recomputed.
+
+  With cache_features=True the per-frame HooF and magnitude are cached
+  too, keyed by the grid, bins, density and flow parameters, so later
+  runs don't decode the video at all.
+
+  With flow_processes > 1 the optical flow of the video is computed in
+  shards of shard_len frames by that many processes. With pipeline=True
+  decoding, optical flow and feature extraction instead run as threads
+  connected by bounded queues, and stats holds their throughput.
+
+  scale and stride are passed on to OpticalFlow to trade accuracy for
+  speed. Use plan.good_cells() with the same scale to pick the grid.
+
+  flow_backend names the flow_backends backend used to compute optical
+  flow, and flow_params overrides its defaults. flow_backend="sparse_lk"
+  tracks corners with a flow_backends.SparseTracker instead, and builds
+  the same per-cell HooF and magnitude from the tracked points. Sparse
+  flows can't be persisted, sharded or batched.
+
+  The flows yielded alongside features only carry their frames with
+  keep_frames=True, for visualization. Otherwise their vectors live in
+  reused buffers and are only valid until the next frame.
+
+  With gate set to a threshold, frame pairs whose frames differ by less
+  than that many gray levels are skipped without computing their flow
+  (see optical_flow.MotionGate). Their features are zeros, or with
+  gate_fill="carry" the features of the previous frame, so the window
+  statistics stay well defined. gated counts the skipped frames.
+
+  timings records the time spent in each stage of extraction and
+  reports progress at most once a second. Pass a timings.Timings to
+  get its reports through a callback, or quiet=True to silence them.
+  Flows computed by other processes or replayed from the cache are
+  timed as a whole under flow.
   """
 
-  def __init__(self, path, persist=False):
+  def __init__(self, path, persist=False, persist_dtype=np.float32,
+               cache_features=False, bins=8, density=True, flow_processes=1,
+               shard_len=50, pipeline=False, scale=1.0, stride=1,
+               flow_backend="farneback", flow_params=None, timings=None,
+               quiet=False, keep_frames=False, gate=None, gate_fill="zeros"):
     self.path = path
     self.persist = persist
+    self.persist_dtype = np.dtype(persist_dtype)
+    self.cache_features = cache_features
+    self.bins = bins
+    self.density = density
+    self.flow_processes = flow_processes
+    self.shard_len = shard_len
+    self.pipeline = pipeline
+    self.scale = scale
+    self.stride = stride
+    self.keep_frames = keep_frames
+    if gate_fill not in ("zeros", "carry"):
+      raise ValueError("gate_fill must be zeros or carry, not %r" % (gate_fill,))
+    self.gate = MotionGate(gate) if gate is not None else None
+    self.gate_fill = gate_fill
+    self.gated = 0
+    self._last_features = None
+    self.backend = get_backend(flow_backend, **(flow_params or {}))
+    if isinstance(self.backend, SparseTracker) and \
+        (persist or flow_processes > 1):
+      raise ValueError("Sparse flows can't be persisted or sharded")
+    self.stats = []
+
+    if timings is None:
+      timings = Timings(quiet=quiet)
+    if timings.total is None:
+      timings.total = (plan.vid_length(path) - 2)//stride
+    self.timings = timings
 
-    # video length minus one because the first 
-    # frame doesn't have an optical flow
-    self.progress = ProgressBar(plan.vid_length(path) - 1)
+  def _gate_key(self, *parts):
+    # keys of caches written before gating existed stay the same
+    if self.gate is None:
+      return ()
+    return (self.gate.params,) + parts
+
+  def flowPath(self):
+    return cache.cache_path("flow", cache.fingerprint(self.path),
+                            self.backend.name, self.backend.params,
+                            self.scale, self.stride, self.persist_dtype.str,
+                            *self._gate_key())
 
   def loadFlows(self):
-    flowPath = "models/flow_%s.npy" % (hashlib.md5(self.path).hexdigest(),)
-    return np.load(flowPath)
+    """
+    Lazily replays flows cached by saveFlows(). Only the vectors are
+    cached so the flows carry no frames.
+    """
+
+    store = FrameStore(self.flowPath())
+    return (Flow.from_vectors(np.asarray(vectors, np.float32))
+            for vectors in store)
+
+  def saveFlows(self, generator):
+    """
+    Passes flows through while writing their vectors to the cache. The
+    cache is only kept if the generator runs to completion.
+    """
+
+    w, h = plan.vid_dims(self.path, self.scale)
+    writer = FrameStoreWriter(self.flowPath(), self.persist_dtype)
+    try:
+      for flow in generator:
+        writer.append(flow.store_vectors((h, w, 2)))
+        yield flow
+    except:
+      writer.abort()
+      raise
+
+    writer.close()
 
-  def saveFlows(self, data):
-    flowPath = "models/flow_%s.npy" % (hashlib.md5(self.path).hexdigest(),)
-    return np.save(flowPath, data)
+  def _compute_flows(self):
+    # the features stage of the pipeline runs behind the flows, so
+    # they can't share buffers
+    optical_flow = OpticalFlow(self.path, self.scale, self.stride,
+                               self.timings, self.keep_frames,
+                               reuse_buffers=not self.pipeline,
+                               gate=self.gate)
+    if isinstance(self.backend, SparseTracker):
+      return optical_flow.tracks(self.backend)
+    if self.flow_processes > 1:
+      return self.timings.timed_iter('flow', optical_flow.sharded(
+        self.backend, self.shard_len, self.flow_processes))
+    if self.pipeline:
+      flows = optical_flow.pipelined(self.backend)
+      self.stats.extend(flows.stats)
+      return flows
+
+    return optical_flow.flows(self.backend)
+
+  def _flows(self):
+    if self.persist:
+      try:
+        return self.timings.timed_iter('flow', self.loadFlows())
+      except (IOError, ValueError):
+        return self.saveFlows(self._compute_flows())
+
+    return self._compute_flows()
+
+  def _flow_dtype(self):
+    # Features are computed from the cached flows, stored as
+    # persist_dtype, only once there are cached flows. Until then they
+    # come from the float32 flows as they're computed.
+    if self.persist and os.path.exists(self.flowPath()):
+      return self.persist_dtype
+    return np.dtype(np.float32)
+
+  def featurePath(self, x_cells, y_cells):
+    return cache.cache_path("features", cache.fingerprint(self.path),
+                            x_cells, y_cells, self.bins, self.density,
+                            self.backend.name, self.backend.params,
+                            self.scale, self.stride, self._flow_dtype().str,
+                            *self._gate_key(self.gate_fill))
+
+  def loadFeatures(self, x_cells, y_cells):
+    """
+    Lazily replays per-frame features cached by saveFeatures(). Nothing
+    is decoded so the yielded flows are None.
+    """
+
+    store = FrameStore(self.featurePath(x_cells, y_cells))
+    bin_edges = np.linspace(-np.pi, np.pi, self.bins+1)
+    return ((np.asarray(fv[..., :-1]), bin_edges, np.asarray(fv[..., -1]), None)
+            for fv in store)
+
+  def saveFeatures(self, x_cells, y_cells, generator):
+    """
+    Passes per-frame features through while writing them to the cache.
+    HooF and magnitude are stored together as one (x_cells, y_cells,
+    bins+1) frame. The cache is only kept if the generator runs to
+    completion.
+    """
+
+    writer = FrameStoreWriter(self.featurePath(x_cells, y_cells), np.float64)
+    try:
+      for hist, bin_edges, magnitude, flow in generator:
+        writer.append(np.concatenate((hist, magnitude[..., np.newaxis]), -1))
+        yield hist, bin_edges, magnitude, flow
+    except:
+      writer.abort()
+      raise
+
+    writer.close()
 
   def features(self, x_cells, y_cells):
     """
     Extracts HooF and flow magnitude from every frame of a video.
     """
 
-    if self.persist:
+    if self.cache_features:
       try:
-        generator = (i for i in self.loadFlows())
-      except:
-        generator = OpticalFlow(self.path).farneback()
+        return self.loadFeatures(x_cells, y_cells)
+      except (IOError, ValueError):
+        return self.saveFeatures(x_cells, y_cells,
+                                 self._features(x_cells, y_cells))
+
+    return self._features(x_cells, y_cells)
+
+  def _gated_features(self, x_cells, y_cells):
+    self.gated += 1
+    if self.gate_fill == "carry" and self._last_features is not None:
+      return self._last_features
+    return (np.zeros((x_cells, y_cells, self.bins)),
+            np.zeros((x_cells, y_cells)))
+
+  def _frame_features(self, flow, x_cells, y_cells):
+    timed = self.timings.timed
+
+    if flow.gated:
+      hist, magnitude = self._gated_features(x_cells, y_cells)
+      return hist, np.linspace(-np.pi, np.pi, self.bins+1), magnitude, flow
+
+    if isinstance(self.backend, SparseTracker):
+      cells, orientations, magnitudes = timed('hoof', track_polar,
+        flow.points, flow.displacements, flow.dims, x_cells, y_cells)
+      hist, bin_edges = timed('hoof', track_hoof, cells, orientations,
+                              magnitudes, self.bins, x_cells, y_cells,
+                              self.density)
+      magnitude = timed('magnitude', track_magnitude, cells, magnitudes,
+                        x_cells, y_cells)
+      self._last_features = hist, magnitude
+      return hist, bin_edges, magnitude, flow
+
+    # the polar conversion is shared, but HooF needs all of it
+    orientations, magnitudes = timed('hoof', cell_polar, flow.vectors,
+                                     x_cells, y_cells)
+    hist, bin_edges = timed('hoof', polar_hoof, orientations, magnitudes,
+                            self.bins, self.density)
+    magnitude = timed('magnitude', polar_magnitude, magnitudes)
+    self._last_features = hist, magnitude
+
+    return hist, bin_edges, magnitude, flow
+
+  def _log(self, message):
+    if not self.timings.quiet:
+      print message
+
+  def _start(self):
+    self.timings.start()
+    self.gated = 0
+    self._last_features = None
+
+  def _finish(self):
+    self.timings.finish()
+    if self.gate is not None:
+      self._log("%d of %d frames static, flow skipped" % (
+        self.gated, self.timings.frames))
+
+  def _features(self, x_cells, y_cells):
+    self.stats = []
+    self._start()
+    generator = self._flows()
+
+    if self.pipeline:
+      generator = Pipeline(generator, [("features",
+        lambda flow: self._frame_features(flow, x_cells, y_cells))],
+        source_name=None)
+      self.stats.extend(generator.stats)
     else:
-      generator = OpticalFlow(self.path).farneback()
+      generator = (self._frame_features(flow, x_cells, y_cells)
+                   for flow in generator)
 
-    flows = []
-    print "Extracting features for %s..." % (self.path,)
-    for pos, flow in enumerate(generator):
-      flows.append(flow)
+    self._log("Extracting features for %s..." % (self.path,))
+    for fv in generator:
+      yield fv
+      # after the yield so the time the consumer spends summarising
+      # this frame is counted with it
+      self.timings.frame()
 
-      off = OpticalFlowFeatures(flow)
+    self._finish()
+    for stats in self.stats:
+      self._log(stats)
 
-      hist, bin_edges = off.cell_hoof(8, x_cells, y_cells, True)
+  def batch_features(self, x_cells, y_cells, chunk_size=32):
+    """
+    Like features() but works on chunk_size frames at a time.
 
-      # +1 because this iteration complete
-      # +1 because 0-based array indexing
-      self.progress.animate(pos+2)
+    Yields (hists, bin_edges, magnitudes, flows) per chunk where hists is
+    (T, x_cells, y_cells, bins), magnitudes is (T, x_cells, y_cells) and
+    flows is the list of the chunk's T flows. Unless keep_frames is set
+    their vectors share reused buffers, so only the last are intact.
+    """
 
-      yield hist, bin_edges, off.magnitude(x_cells, y_cells), flow
+    if isinstance(self.backend, SparseTracker):
+      raise ValueError("batch_features() needs dense flows")
 
-    print
+    self._start()
+    generator = self._flows()
+    w, h = plan.vid_dims(self.path, self.scale)
 
-    if self.persist:
-      self.saveFlows(flows)
+    self._log("Extracting features for %s..." % (self.path,))
+    vectors = np.empty((chunk_size, h, w, 2), np.float32)
+    while True:
+      flows = []
+      for flow in islice(generator, chunk_size):
+        # copy straight away, before the next flow reuses the buffer
+        vectors[len(flows)] = 0 if flow.gated else flow.vectors
+        flows.append(flow)
+      if not flows:
+        break
 
+      hists, bin_edges, magnitudes = self.timings.timed('hoof',
+        batch_hoof_magnitude, vectors[:len(flows)], self.bins, x_cells,
+        y_cells, self.density)
+
+      for i, flow in enumerate(flows):
+        if flow.gated:
+          hists[i], magnitudes[i] = self._gated_features(x_cells, y_cells)
+        else:
+          self._last_features = hists[i], magnitudes[i]
+
+      yield hists, bin_edges, magnitudes, flows
+      self.timings.frame(len(flows))
+
+    self._finish()
+
+  def multi_grid_features(self, grids):
+    """
+    Extracts HooF and flow magnitude for several grids from every frame
+    of a video, e.g. grids=[(1, 1), (2, 2), (4, 4)] for a spatial
+    pyramid.
+
+    Each frame's flow is turned into an IntegralHoof once, and every
+    grid is read off it. Grids needn't divide the frame: their cells
+    cover the whole frame with boundaries from grid_edges().
+
+    Yields (features, flow) where features holds a (hist, bin_edges,
+    magnitude) per grid, in the order of grids.
+    """
+
+    if isinstance(self.backend, SparseTracker):
+      raise ValueError("multi_grid_features() needs dense flows")
+
+    self._start()
+    last = None
+
+    self._log("Extracting features for %s..." % (self.path,))
+    for flow in self._flows():
+      if flow.gated:
+        self.gated += 1
+        if self.gate_fill != "carry" or last is None:
+          bin_edges = np.linspace(-np.pi, np.pi, self.bins+1)
+          last = [(np.zeros((x, y, self.bins)), bin_edges, np.zeros((x, y)))
+                  for x, y in grids]
+      else:
+        integral = self.timings.timed('hoof', IntegralHoof, flow.vectors,
+                                      self.bins)
+        last = [self.timings.timed('hoof', integral.grid, x, y, self.density)
+                for x, y in grids]
+
+      yield last, flow
+      self.timings.frame()
+
+    self._finish()
 
   def aggregate_features(self, x_cells, y_cells, window_size=None):
-    hists = []
-    magnitudes = []
+    stats = None
 
     for pos, fv in enumerate(self.features(x_cells, y_cells)):
       hist, bin_edges, magnitude, flow = fv
-      if window_size and len(hists) == window_size:
-        yield self.summarise_features(hists, magnitudes, bin_edges) + (flow,)
-        hists.pop(0)
-        magnitudes.pop(0)
+      if stats is None:
+        stats = WindowStats(hist.shape, window_size)
+      if window_size and stats.count == window_size:
+        yield self.timings.timed('summarise', stats.summary,
+                                 bin_edges) + (flow,)
 
-      hists.append(hist)
-      magnitudes.append(magnitude)
+      self.timings.timed('summarise', stats.push, hist, magnitude)
 
     if not window_size:
-      yield self.summarise_features(hists, magnitudes, bin_edges) + (flow,)
+      yield self.timings.timed('summarise', stats.summary,
+                               bin_edges) + (flow,)
+
+  def multi_window_features(self, x_cells, y_cells, window_sizes,
+                            cumulative=False):
+    """
+    Summaries of several window sizes, e.g. [8, 16, 32], from a single
+    pass over the video.
+
+    Yields (pos, summaries, cumulative_summary, flow) after every frame
+    pos, where summaries holds one summary per window size covering
+    the frames up to and including pos, or None while that window isn't
+    full yet. cumulative_summary covers frames 0 to pos if cumulative,
+    so the last one is the summary of the whole video, and is otherwise
+    None. Summaries are shaped like aggregate_features()'s.
+    """
+
+    stats = None
+
+    for pos, (hist, bin_edges, magnitude, flow) in enumerate(
+        self.features(x_cells, y_cells)):
+      if stats is None:
+        stats = MultiWindowStats(hist.shape, window_sizes, cumulative)
+
+      timed = self.timings.timed
+      timed('summarise', stats.push, hist, magnitude)
+      summaries = timed('summarise', stats.summaries, bin_edges)
+      cumulative_summary = None
+      if cumulative:
+        cumulative_summary = timed('summarise', stats.cumulative_summary,
+                                   bin_edges)
+
+      yield pos, summaries, cumulative_summary, flow
 
   def summarise_features(self, hists, magnitudes, bin_edges):
     #hists = np.swapaxes(np.swapaxes(hists, 0, 1), 1, 2)
@@ -87,14 +433,10 @@ class VideoFeatures:
     avg_hists = np.nanmean(hists, 0)
 
     # Mean of flow magnitudes
-    avg_magnitudes = np.nanmean(magnitudes, 0)
-    avg_magnitudes = (avg_magnitudes-np.nanmin(avg_magnitudes))/(
-      np.nanmax(avg_magnitudes)-np.nanmin(avg_magnitudes))
+    avg_magnitudes = normalise(np.nanmean(magnitudes, 0))
 
     # Sum of the variances over time in each bin in each cell
-    variances = np.sum(np.nanvar(hists, 0), 2)
-    variances = (variances-np.nanmin(variances))/(
-      np.nanmax(variances)-np.nanmin(variances))
+    variances = normalise(np.sum(np.nanvar(hists, 0), 2))
 
     return avg_hists, bin_edges, avg_magnitudes, variances
 
@@ -0,0 +1,193 @@
+import numpy as np
+
+def normalise(a):
+  """
+  Rescale a to the range [0, 1], ignoring NaNs. A constant a, such as
+  the magnitudes of a window of static frames, becomes all zeros.
+  """
+
+  lo = np.nanmin(a)
+  hi = np.nanmax(a)
+  if hi == lo:
+    return a - lo
+  return (a-lo)/(hi-lo)
+
+def _split(a):
+  valid = ~np.isnan(a)
+  return np.where(valid, a, 0), valid
+
+class _RunningSums:
+  """
+  NaN-aware sums of HooF, squared HooF and magnitude over a set of
+  frames that frames can be added to and removed from.
+  """
+
+  def __init__(self, hist_shape):
+    mag_shape = hist_shape[:-1]
+    self.hist_sum = np.zeros(hist_shape)
+    self.hist_sqsum = np.zeros(hist_shape)
+    self.hist_n = np.zeros(hist_shape)
+    self.mag_sum = np.zeros(mag_shape)
+    self.mag_n = np.zeros(mag_shape)
+
+  def add(self, hist, magnitude, sign=1):
+    hist, hist_valid = _split(hist)
+    magnitude, mag_valid = _split(magnitude)
+    self.hist_sum += sign*hist
+    self.hist_sqsum += sign*np.square(hist)
+    self.hist_n += sign*hist_valid
+    self.mag_sum += sign*magnitude
+    self.mag_n += sign*mag_valid
+
+  def rebuild(self, hists, mags):
+    # Adding and subtracting accumulates rounding error, so windows
+    # rebuild their sums from the frames every so often.
+    hists, hist_valid = _split(hists)
+    mags, mag_valid = _split(mags)
+    self.hist_sum = hists.sum(0)
+    self.hist_sqsum = np.square(hists).sum(0)
+    self.hist_n = hist_valid.sum(0).astype(float)
+    self.mag_sum = mags.sum(0)
+    self.mag_n = mag_valid.sum(0).astype(float)
+
+  def summary(self, bin_edges):
+    with np.errstate(divide='ignore', invalid='ignore'):
+      avg_hists = self.hist_sum/self.hist_n
+      avg_magnitudes = self.mag_sum/self.mag_n
+      variances = np.maximum(self.hist_sqsum/self.hist_n -
+                             np.square(avg_hists), 0)
+
+    avg_magnitudes = normalise(avg_magnitudes)
+    variances = normalise(np.sum(variances, 2))
+
+    return avg_hists, bin_edges, avg_magnitudes, variances
+
+class WindowStats:
+  """
+  Running statistics of per-frame HooF and flow magnitude.
+
+  With a window_size the statistics cover the last window_size frames
+  pushed and old frames are evicted from a preallocated ring buffer.
+  Without one they cover every frame pushed so far and nothing but the
+  running sums is kept. Either way push() and summary() cost the same
+  regardless of how many frames are covered.
+
+  NaNs are ignored, as np.nanmean and np.nanvar would.
+  """
+
+  def __init__(self, hist_shape, window_size=None):
+    self.hist_shape = tuple(hist_shape)
+    self.window_size = window_size
+    self.count = 0
+    self._sums = _RunningSums(self.hist_shape)
+
+    if window_size:
+      self._hists = np.empty((window_size,) + self.hist_shape)
+      self._mags = np.empty((window_size,) + self.hist_shape[:-1])
+      self._pos = 0
+      self._evictions = 0
+
+  def push(self, hist, magnitude):
+    """
+    Add a frame's HooF and magnitude, evicting the oldest frame if the
+    window is full.
+    """
+
+    if not self.window_size:
+      self._sums.add(hist, magnitude)
+      self.count += 1
+      return
+
+    if self.count == self.window_size:
+      self._sums.add(self._hists[self._pos], self._mags[self._pos], -1)
+      self._evictions += 1
+    else:
+      self.count += 1
+
+    self._hists[self._pos] = hist
+    self._mags[self._pos] = magnitude
+    self._pos = (self._pos+1) % self.window_size
+
+    # every window_size evictions, which amortized is still constant
+    # work per frame
+    if self._evictions == self.window_size:
+      self._evictions = 0
+      self._sums.rebuild(self._hists, self._mags)
+    else:
+      self._sums.add(hist, magnitude)
+
+  def summary(self, bin_edges):
+    """
+    Same output as VideoFeatures.summarise_features() for the frames
+    currently covered.
+    """
+
+    return self._sums.summary(bin_edges)
+
+class MultiWindowStats:
+  """
+  WindowStats for several window sizes at once, all ending at the same
+  frame, sharing one ring buffer the size of the largest window.
+
+  With cumulative=True the statistics of every frame pushed so far are
+  kept too.
+  """
+
+  def __init__(self, hist_shape, window_sizes, cumulative=False):
+    self.hist_shape = tuple(hist_shape)
+    self.window_sizes = list(window_sizes)
+    self.count = 0
+
+    self._capacity = max(self.window_sizes)
+    self._hists = np.empty((self._capacity,) + self.hist_shape)
+    self._mags = np.empty((self._capacity,) + self.hist_shape[:-1])
+    self._sums = [_RunningSums(self.hist_shape) for _ in self.window_sizes]
+    self._evictions = [0]*len(self.window_sizes)
+    self._cumulative = _RunningSums(self.hist_shape) if cumulative else None
+
+  def push(self, hist, magnitude):
+    """
+    Add a frame's HooF and magnitude, evicting frames that have left
+    each window.
+    """
+
+    # evict before the new frame can overwrite the largest window's
+    # oldest frame
+    for i, window_size in enumerate(self.window_sizes):
+      if self.count >= window_size:
+        old = (self.count - window_size) % self._capacity
+        self._sums[i].add(self._hists[old], self._mags[old], -1)
+        self._evictions[i] += 1
+
+    pos = self.count % self._capacity
+    self._hists[pos] = hist
+    self._mags[pos] = magnitude
+    self.count += 1
+
+    for i, window_size in enumerate(self.window_sizes):
+      if self._evictions[i] == window_size:
+        self._evictions[i] = 0
+        frames = np.arange(self.count - window_size,
+                           self.count) % self._capacity
+        self._sums[i].rebuild(self._hists[frames], self._mags[frames])
+      else:
+        self._sums[i].add(hist, magnitude)
+
+    if self._cumulative is not None:
+      self._cumulative.add(hist, magnitude)
+
+  def summaries(self, bin_edges):
+    """
+    One summary per window size, in the order they were given, like
+    WindowStats.summary(). Windows that aren't full yet give None.
+    """
+
+    return [sums.summary(bin_edges) if self.count >= window_size else None
+            for window_size, sums in zip(self.window_sizes, self._sums)]
+
+  def cumulative_summary(self, bin_edges):
+    """
+    Summary of every frame pushed so far, if cumulative.
+    """
+
+    return self._cumulative.summary(bin_edges)
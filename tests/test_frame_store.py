@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from actipy.frame_store import FrameStore, FrameStoreWriter
+
+class FrameStoreTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp(prefix="actipy_test_")
+    self.path = os.path.join(self.directory, "flows", "video.flow")
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def write(self, frames, dtype, meta=None):
+    writer = FrameStoreWriter(self.path, dtype, meta)
+    for frame in frames:
+      writer.append(frame)
+    writer.close()
+
+  def test_round_trip(self):
+    rng = np.random.RandomState(0)
+    frames = rng.randn(5, 6, 4, 2)*10
+    meta = {'backend': 'farneback', 'params': {'levels': 3}, 'scale': 0.5}
+
+    for dtype in (np.float16, np.float32):
+      self.write(frames, dtype, meta)
+      self.assertEqual(os.listdir(os.path.dirname(self.path)),
+                       ["video.flow"])
+
+      store = FrameStore(self.path)
+      self.assertEqual(store.dtype, np.dtype(dtype))
+      self.assertEqual(store.shape, frames.shape)
+      self.assertEqual(store.meta, meta)
+      self.assertEqual(len(store), len(frames))
+      self.assertEqual(store[2].dtype, np.dtype(dtype))
+      np.testing.assert_array_equal(np.array(list(store)),
+                                    frames.astype(dtype))
+
+  def test_empty_store(self):
+    self.write([], np.float16)
+
+    store = FrameStore(self.path)
+    self.assertEqual(store.dtype, np.dtype(np.float16))
+    self.assertEqual(len(store), 0)
+    self.assertEqual(list(store), [])
+
+  def test_shape_mismatch(self):
+    writer = FrameStoreWriter(self.path)
+    writer.append(np.zeros((4, 3, 2)))
+    self.assertRaises(ValueError, writer.append, np.zeros((3, 4, 2)))
+    writer.abort()
+    self.assertEqual(os.listdir(os.path.dirname(self.path)), [])
+
+  def test_not_a_store(self):
+    os.makedirs(os.path.dirname(self.path))
+    with open(self.path, 'wb') as f:
+      f.write(b'\0' * 1024)
+    self.assertRaises(ValueError, FrameStore, self.path)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,114 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from actipy.manifest import Manifest
+
+SETTINGS = {'grid': [3, 3], 'bins': 8}
+
+class ManifestTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp(prefix="actipy_test_")
+    self.path = os.path.join(self.directory, "manifest")
+    self.calls = []
+    self.failing = set()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def video(self, name, content):
+    path = os.path.join(self.directory, name)
+    with open(path, 'wb') as f:
+      f.write(content)
+    return path
+
+  def featurize(self, paths):
+    # the feature vector is the video's length, so rows can be checked
+    self.calls.append(list(paths))
+    for path in paths:
+      if path in self.failing:
+        yield path, None, "can't decode"
+      else:
+        yield path, np.array([os.path.getsize(path), 1.0]), None
+
+  def update(self, videos):
+    manifest = Manifest.load(self.path, SETTINGS)
+    result = manifest.update(videos, self.featurize)
+    manifest.save(self.path)
+    return manifest, result
+
+  def test_only_new_and_changed_videos_are_featurized(self):
+    walk = self.video("walk.avi", b'w'*10)
+    run = self.video("run.avi", b'r'*20)
+    sit = self.video("sit.avi", b's'*30)
+    videos = [(walk, 'walk'), (run, 'run'), (sit, 'sit')]
+
+    manifest, result = self.update(videos)
+    self.assertEqual(result, (sorted([walk, run, sit]), [], []))
+    np.testing.assert_array_equal(manifest.features[:, 0], [10, 20, 30])
+
+    # unchanged: nothing to featurize
+    self.calls = []
+    manifest, result = self.update(videos)
+    self.assertEqual(self.calls, [])
+    self.assertEqual(result, ([], [], []))
+    np.testing.assert_array_equal(manifest.features[:, 0], [10, 20, 30])
+
+    # run changes, sit is deleted and jump is new
+    self.video("run.avi", b'R'*25)
+    os.remove(sit)
+    jump = self.video("jump.avi", b'j'*40)
+    videos = [(walk, 'walk'), (run, 'run'), (jump, 'jump')]
+
+    manifest, result = self.update(videos)
+    self.assertEqual(self.calls, [sorted([run, jump])])
+    self.assertEqual(result, (sorted([run, jump]), [sit], []))
+    self.assertEqual([v['path'] for v in manifest.videos], [walk, run, jump])
+    np.testing.assert_array_equal(manifest.features[:, 0], [10, 25, 40])
+
+    feature_vectors, categories = manifest.training_set([jump, sit, walk])
+    np.testing.assert_array_equal(np.array(feature_vectors)[:, 0], [40, 10])
+    self.assertEqual(categories, ['jump', 'walk'])
+
+  def test_renamed_video_keeps_its_features(self):
+    walk = self.video("walk.avi", b'w'*10)
+    self.update([(walk, 'walk')])
+
+    renamed = os.path.join(self.directory, "walking.avi")
+    os.rename(walk, renamed)
+    self.calls = []
+    manifest, result = self.update([(renamed, 'walk')])
+    self.assertEqual(self.calls, [])
+    self.assertEqual(result, ([], [walk], []))
+    self.assertEqual([v['path'] for v in manifest.videos], [renamed])
+
+  def test_failed_videos_are_retried(self):
+    walk = self.video("walk.avi", b'w'*10)
+    run = self.video("run.avi", b'r'*20)
+    videos = [(walk, 'walk'), (run, 'run')]
+
+    self.failing = set([run])
+    manifest, result = self.update(videos)
+    self.assertEqual(result, ([walk], [], [run]))
+    self.assertEqual([v['path'] for v in manifest.videos], [walk])
+
+    self.failing = set()
+    self.calls = []
+    manifest, result = self.update(videos)
+    self.assertEqual(self.calls, [[run]])
+    self.assertEqual([v['path'] for v in manifest.videos], [walk, run])
+
+  def test_other_settings_invalidate(self):
+    walk = self.video("walk.avi", b'w'*10)
+    self.update([(walk, 'walk')])
+
+    manifest = Manifest.load(self.path, dict(SETTINGS, bins=4))
+    self.assertEqual(manifest.videos, [])
+    self.assertEqual(len(Manifest.load(self.path, SETTINGS).videos), 1)
+
+if __name__ == "__main__":
+  unittest.main()
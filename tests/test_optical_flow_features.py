@@ -0,0 +1,85 @@
+import unittest
+
+import numpy as np
+
+from actipy.optical_flow_features import hoof_magnitude, IntegralHoof, \
+  track_hoof_magnitude
+
+def edge_flow(dtype, seed=0):
+  """
+  Random flow with plenty of vectors whose orientation is exactly on a
+  bin edge, including -pi from a -0.0 x-component.
+  """
+
+  rng = np.random.RandomState(seed)
+  vectors = rng.randn(24, 24, 2).astype(dtype)
+  vectors[::3, :, 0] = -0.0
+  vectors[1::5, :, 0] = -1e-9
+  vectors[2::6, 1::3, 0] = 0.0
+  vectors[::4, ::2, 1] = 0.0
+  vectors[::7, ::3] = rng.choice([-1, 1], (4, 8, 2)) * \
+    rng.choice([0, 1], (4, 8, 2))
+  vectors[5, 5] = (-0.0, -1)
+  vectors[6, 6] = (0.0, -1)
+  return vectors
+
+def reference_hoof(vectors, bins, x_cells, y_cells):
+  """
+  HooF of every cell with np.histogram, as OpticalFlowFeatures does.
+  """
+
+  y_cl = vectors.shape[0]//y_cells
+  x_cl = vectors.shape[1]//x_cells
+  hists = np.zeros((x_cells, y_cells, bins))
+  for i in range(x_cells):
+    for j in range(y_cells):
+      cell = vectors[j*y_cl:(j+1)*y_cl, i*x_cl:(i+1)*x_cl]
+      x = cell[..., 0]
+      y = cell[..., 1]
+      hists[i, j] = np.histogram(np.arctan2(x, y), bins=bins,
+                                 range=(-np.pi, np.pi),
+                                 weights=np.sqrt(np.square(x) +
+                                                 np.square(y)))[0]
+  return hists
+
+class EdgeAngleTest(unittest.TestCase):
+
+  def test_hoof_magnitude_matches_histogram(self):
+    for dtype in (np.float32, np.float64):
+      vectors = edge_flow(dtype)
+      for bins in (4, 8, 12):
+        hists, _, _ = hoof_magnitude(vectors, bins, 3, 4)
+        np.testing.assert_allclose(hists,
+                                   reference_hoof(vectors, bins, 3, 4),
+                                   rtol=1e-6, atol=1e-6)
+
+  def test_integral_hoof_matches_polar_hoof(self):
+    for dtype in (np.float32, np.float64):
+      vectors = edge_flow(dtype)
+      for bins in (4, 8):
+        hists, _, magnitudes = hoof_magnitude(vectors, bins, 3, 4)
+        integral = IntegralHoof(vectors, bins)
+        grid_hists, _, grid_magnitudes = integral.grid(3, 4)
+        np.testing.assert_allclose(grid_hists, hists, rtol=1e-6, atol=1e-6)
+        np.testing.assert_allclose(grid_magnitudes, magnitudes, rtol=1e-6)
+
+        # the count channel must not pick up any magnitude
+        _, _, magnitude = integral.rect(0, 0, 24, 24)
+        self.assertAlmostEqual(magnitude, np.sqrt(np.square(
+          vectors.astype(float)).sum(-1)).mean(), places=5)
+
+  def test_track_hoof_at_pi(self):
+    points = np.array([[1, 1], [1, 1], [13, 1]], dtype=np.float32)
+    displacements = np.array([[-0.0, -1], [0.0, -1], [-1e-9, -1]],
+                             dtype=np.float32)
+    hists, _, _ = track_hoof_magnitude(points, displacements, (24, 24), 8,
+                                       2, 2)
+    x = displacements[:, 0]
+    y = displacements[:, 1]
+    expected = np.histogram(np.arctan2(x, y), bins=8, range=(-np.pi, np.pi))[0]
+    self.assertEqual(hists[0, 0].sum() + hists[1, 0].sum(), 3)
+    np.testing.assert_array_equal(hists[0, 0] + hists[1, 0], expected)
+    self.assertEqual(hists[0, 1].sum() + hists[1, 1].sum(), 0)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,35 @@
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from actipy.benchmark import synthetic_video
+from actipy.video_features import VideoFeatures
+
+class BatchFeaturesTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp(prefix="actipy_test_")
+    self.path = synthetic_video(self.directory, 'rotate', 64, 48, 12)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_batch_features_match_features(self):
+    expected = list(VideoFeatures(self.path, quiet=True).features(4, 3))
+    hists = np.array([f[0] for f in expected])
+    magnitudes = np.array([f[2] for f in expected])
+
+    # flows share reused buffers, so chunks of more than two frames
+    # catch any flow that isn't copied before the next one is computed
+    for chunk_size in (3, 4, 32):
+      chunks = list(VideoFeatures(self.path, quiet=True).batch_features(
+        4, 3, chunk_size))
+      np.testing.assert_allclose(np.concatenate([c[0] for c in chunks]),
+                                 hists)
+      np.testing.assert_allclose(np.concatenate([c[2] for c in chunks]),
+                                 magnitudes)
+
+if __name__ == "__main__":
+  unittest.main()
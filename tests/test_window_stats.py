@@ -0,0 +1,97 @@
+import shutil
+import tempfile
+import unittest
+import warnings
+
+import numpy as np
+
+from actipy.benchmark import synthetic_video
+from actipy.video_features import VideoFeatures
+from actipy.window_stats import WindowStats, MultiWindowStats
+
+BINS = 4
+BIN_EDGES = np.linspace(-np.pi, np.pi, BINS+1)
+
+def random_frames(n, seed=0):
+  """
+  Random HooF and magnitudes of n frames of a 3x2 grid, with cells
+  without flow (NaN), wholly NaN frames, and frames that are all zeros
+  or a copy of the previous frame as gated frames are.
+  """
+
+  rng = np.random.RandomState(seed)
+  hists = rng.rand(n, 3, 2, BINS)
+  magnitudes = rng.rand(n, 3, 2)*5
+
+  empty = rng.rand(n, 3, 2) < 0.1
+  hists[empty] = np.nan
+  magnitudes[empty] = np.nan
+  hists[7] = np.nan
+  magnitudes[7] = np.nan
+
+  hists[3] = 0
+  magnitudes[3] = 0
+  hists[11] = hists[10]
+  magnitudes[11] = magnitudes[10]
+  return hists, magnitudes
+
+class WindowStatsTest(unittest.TestCase):
+
+  def setUp(self):
+    # summarise_features() doesn't look at the video, but VideoFeatures
+    # needs one
+    self.directory = tempfile.mkdtemp(prefix="actipy_test_")
+    path = synthetic_video(self.directory, 'rotate', 32, 24, 4)
+    self.video_features = VideoFeatures(path, quiet=True)
+    self.hists, self.magnitudes = random_frames(60)
+
+    # windows of only the NaN frame have no statistics either way
+    self.warnings = warnings.catch_warnings()
+    self.warnings.__enter__()
+    warnings.simplefilter("ignore", RuntimeWarning)
+
+  def tearDown(self):
+    self.warnings.__exit__()
+    shutil.rmtree(self.directory)
+
+  def assert_summary(self, summary, start, stop):
+    expected = self.video_features.summarise_features(
+      self.hists[start:stop], self.magnitudes[start:stop], BIN_EDGES)
+
+    self.assertEqual(len(summary), len(expected))
+    for actual, wanted in zip(summary, expected):
+      np.testing.assert_allclose(actual, wanted, rtol=1e-7, atol=1e-9)
+
+  def test_window_matches_summarise_features(self):
+    # 60 frames evict every frame of the smaller windows several times
+    # over, so the sums have been rebuilt from the ring buffer
+    for window_size in (1, 4, 9, 25):
+      stats = WindowStats(self.hists.shape[1:], window_size)
+      for i in xrange(len(self.hists)):
+        stats.push(self.hists[i], self.magnitudes[i])
+        if stats.count == window_size:
+          self.assert_summary(stats.summary(BIN_EDGES),
+                              i+1-window_size, i+1)
+
+  def test_cumulative_matches_summarise_features(self):
+    stats = WindowStats(self.hists.shape[1:])
+    for i in xrange(len(self.hists)):
+      stats.push(self.hists[i], self.magnitudes[i])
+      self.assert_summary(stats.summary(BIN_EDGES), 0, i+1)
+
+  def test_multi_window_matches_summarise_features(self):
+    window_sizes = [9, 1, 25, 4]
+    stats = MultiWindowStats(self.hists.shape[1:], window_sizes,
+                             cumulative=True)
+    for i in xrange(len(self.hists)):
+      stats.push(self.hists[i], self.magnitudes[i])
+      for window_size, summary in zip(window_sizes,
+                                      stats.summaries(BIN_EDGES)):
+        if i+1 < window_size:
+          self.assertIsNone(summary)
+        else:
+          self.assert_summary(summary, i+1-window_size, i+1)
+      self.assert_summary(stats.cumulative_summary(BIN_EDGES), 0, i+1)
+
+if __name__ == "__main__":
+  unittest.main()